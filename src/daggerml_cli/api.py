@@ -1,9 +1,10 @@
 import logging
 import os
 import subprocess
-from contextlib import contextmanager
+from collections.abc import Mapping, Set
+from contextlib import contextmanager, nullcontext
 from copy import copy
-from dataclasses import fields, is_dataclass
+from dataclasses import dataclass, fields, is_dataclass, replace
 from shutil import rmtree
 from typing import TYPE_CHECKING, Union, cast
 
@@ -14,6 +15,7 @@ from asciidag.node import Node as AsciiNode
 from daggerml_cli.db import Cache
 from daggerml_cli.repo import (
     BUILTIN_FNS,
+    DATA_TYPE,
     DEFAULT_BRANCH,
     CheckedRef,
     Ctx,
@@ -28,10 +30,11 @@ from daggerml_cli.repo import (
     Node,
     Ref,
     Repo,
+    plain_collections,
     unroll_datum,
 )
 from daggerml_cli.topology import node_info, topology
-from daggerml_cli.util import asserting, detect_executable, flatten, makedirs, some
+from daggerml_cli.util import asserting, detect_executable, flatten, makedirs, some, tree_map
 
 if TYPE_CHECKING:
     from daggerml_cli.config import Config
@@ -50,9 +53,9 @@ def jsdata(x, full_id=True):
         if _data is None:
             return id
         x = {"id": id, **{k: getattr(x, k) for k in _data}}
-    if isinstance(x, (tuple, list, set)):
+    if isinstance(x, (tuple, list, Set)):
         return [jsdata(y, full_id=full_id) for y in x]
-    if isinstance(x, dict):
+    if isinstance(x, Mapping):
         return {k: jsdata(v, full_id=full_id) for k, v in x.items()}
     if is_dataclass(x):
         return jsdata(x.__dict__, full_id=full_id)
@@ -65,7 +68,7 @@ def with_query(f, query):
 
 def with_attrs(x, **kwargs):
     x = copy(x)
-    y = x()
+    y = plain_collections(x())  # so the result can be used outside the transaction
     kwargs.update({field.name: getattr(y, field.name) for field in fields(y)})
     for k, v in kwargs.items():
         object.__setattr__(x, k, v)
@@ -93,9 +96,9 @@ def list_other_repo(config):
     return [k for k in list_repo(config) if k["name"] != config.REPO]
 
 
-def create_repo(config, name):
+def create_repo(config, name, hash_algo=None):
     config._REPO = name
-    with Repo(makedirs(config.REPO_PATH), user=config.USER, create=True):
+    with Repo(makedirs(config.REPO_PATH), user=config.USER, create=True, hash_algo=hash_algo, **config.REPO_OPTIONS):
         pass
 
 
@@ -105,28 +108,43 @@ def delete_repo(config, name):
 
 
 def copy_repo(config, name):
-    with Repo(config.REPO_PATH) as db:
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
         db.copy(os.path.join(config.REPO_DIR, name))
 
 
-def gc_repo(config):
-    with Repo(config.REPO_PATH) as db:
+def gc_repo(config, limit=None):
+    def gc(db):
         with db.tx(True):
-            return db.gc()
+            return db.gc(limit=limit)
+
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
+        return db.transact(gc, db)
+
+
+def migrate_hash_repo(config, algo):
+    def migrate(db):
+        with db.tx(True):
+            return db.migrate_hash(algo)
+
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
+        return db.transact(migrate, db)
 
 
 def list_deleted(config):
-    with Repo(config.REPO_PATH) as db:
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
         with db.tx():
             return [{"id": x, **x().__dict__} for x in db.objects("deleted")]
 
 
 def remove_deleted(config, ref):
-    with Repo(config.REPO_PATH) as db:
+    def remove(db):
         with db.tx(True):
             assert ref.type == "deleted"
             db.delete(ref)
 
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
+        db.transact(remove, db)
+
 
 ###############################################################################
 # REF #########################################################################
@@ -134,16 +152,19 @@ def remove_deleted(config, ref):
 
 
 def dump_ref(config, ref, recursive=True):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
         with db.tx():
             return db.dump_ref(ref, recursive)
 
 
 def load_ref(config, ref):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    def load(db):
         with db.tx(True):
             return db.load_ref(ref)
 
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        return db.transact(load, db)
+
 
 ###############################################################################
 # STATUS ######################################################################
@@ -195,7 +216,7 @@ def current_branch(config):
 
 
 def list_branch(config):
-    with Repo(config.REPO_PATH) as db:
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
         with db.tx():
             return sorted([x for x in db.heads()], key=lambda y: y.id)
 
@@ -208,33 +229,46 @@ def create_branch(config, name, commit=None):
     kw = {}
     if commit is not None:
         kw["head"] = config.BRANCHREF
-    with Repo(config.REPO_PATH, **kw) as db:
+
+    def create(db):
         with db.tx(True):
             ref = db.head if commit is None else Ref(f"commit/{commit}")
             db.create_branch(Ref(f"head/{name}"), ref)
+
+    with Repo(config.REPO_PATH, **kw, **config.REPO_OPTIONS) as db:
+        db.transact(create, db)
     config_branch(config, name)
 
 
 def delete_branch(config, name):
-    with Repo(config.REPO_PATH) as db:
+    def delete(db):
         with db.tx(True):
             db.delete_branch(Ref(f"head/{name}"))
 
+    with Repo(config.REPO_PATH, **config.REPO_OPTIONS) as db:
+        db.transact(delete, db)
+
 
 def merge_branch(config, name):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    def merge(db):
         with db.tx(True):
             ref = db.merge(db.head().commit, Ref(f"head/{name}")().commit)
             db.checkout(db.set_head(db.head, ref))
-        return ref.id
+        return ref
+
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        return db.transact(merge, db).id
 
 
 def rebase_branch(config, name):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    def rebase(db):
         with db.tx(True):
             ref = db.rebase(Ref(f"head/{name}")().commit, db.head().commit)
             db.checkout(db.set_head(db.head, ref))
-        return ref.id
+        return ref
+
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        return db.transact(rebase, db).id
 
 
 ###############################################################################
@@ -243,33 +277,39 @@ def rebase_branch(config, name):
 
 
 def list_dags(config, *, all=False):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
         with db.tx():
             dags = Ctx.from_head(db.head).dags
             result = [with_attrs(v, name=k) for k, v in dags.items()]
             if all:
                 dag_ids = [d.to for d in dags.values()]
-                for obj in db.walk(db.head):
+                for obj in db.walk(db.head, prune=["datum"]):
                     if isinstance(obj(), Dag) and obj.to not in dag_ids:
                         result.append(with_attrs(obj, name=None))
             return result
 
 
 def delete_dag(config, name, message):
-    with Repo(config.REPO_PATH, user=config.USER, head=config.BRANCHREF) as db:
+    def delete(db):
         with db.tx(True):
             return db.delete_dag(name, message)
 
+    with Repo(config.REPO_PATH, user=config.USER, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        return db.transact(delete, db)
+
 
 def begin_dag(config, *, name=None, message, dump=None):
-    with Repo(config.REPO_PATH, user=config.USER, head=config.BRANCHREF) as db:
+    def begin(db):
         with db.tx(True):
             return db.begin(name=name, message=message, dump=dump)
 
+    with Repo(config.REPO_PATH, user=config.USER, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        return db.transact(begin, db)
+
 
 def get_dag(config, name_or_id, db=None):
     if db is None:
-        with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+        with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
             with db.tx():
                 return get_dag(None, name_or_id, db=db)
     if len([x for x in list(name_or_id) if x == "/"]) == 1:
@@ -280,7 +320,7 @@ def get_dag(config, name_or_id, db=None):
 
 
 def describe_dag(config, ref):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
         with db.tx():
             assert isinstance(ref(), Dag)
             desc = topology(db, ref)
@@ -293,33 +333,50 @@ def describe_dag(config, ref):
 
 
 def create_cache(config):
-    with Cache(config.CACHE_PATH, create=True):
+    with Cache(config.CACHE_PATH, create=True, **config.CACHE_OPTIONS):
         pass
 
 
 def delete_cache(config, cache_key: Ref):
-    with Cache(config.CACHE_PATH) as cache:
+    with Cache(config.CACHE_PATH, **config.CACHE_OPTIONS) as cache:
         return cache.delete(cache_key)
 
 
-def list_cache(config):
-    with Cache(config.CACHE_PATH) as cache:
-        return cache.list()
+def list_cache(config, **kw):
+    with Cache(config.CACHE_PATH, **config.CACHE_OPTIONS) as cache:
+        return cache.list(**kw)
+
+
+def evict_cache(config, **kw):
+    with Cache(config.CACHE_PATH, **config.CACHE_OPTIONS) as cache:
+        return cache.evict(replace(cache.eviction, **{k: v for k, v in kw.items() if v is not None}))
+
+
+def stats_cache(config):
+    with Cache(config.CACHE_PATH, **config.CACHE_OPTIONS) as cache:
+        return cache.stats()
 
 
 def info_cache(config, cache_key: Ref):
-    with Cache(config.CACHE_PATH) as cache:
+    with Cache(config.CACHE_PATH, **config.CACHE_OPTIONS) as cache:
         return cache.describe(cache_key)
 
 
+def dag_fn(config, dag: Ref):
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        with db.tx():
+            argv = getattr(dag(), "argv", None)
+            return unroll_datum(argv().value)[0] if argv is not None else None
+
+
 def put_cache(config: "Config", dag: Ref):
-    with Cache(cast(str, config.CACHE_PATH)) as cache:
+    with Cache(cast(str, config.CACHE_PATH), **config.CACHE_OPTIONS) as cache:
         dump = dump_ref(config, dag, recursive=True)
         assert isinstance(dump, str), "dump_ref should return a JSON string"
         cache_key = describe_dag(config, dag)["cache_key"]
         if cache_key is None:
             raise ValueError("dag has no cache key")
-        cache.put(cache_key, dump, old_value=None)
+        cache.put(cache_key, dump, old_value=None, fn=dag_fn(config, dag))
     return cache_key
 
 
@@ -329,7 +386,7 @@ def put_cache(config: "Config", dag: Ref):
 
 
 def list_indexes(config):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
         with db.tx():
             return [
                 with_attrs(
@@ -344,10 +401,13 @@ def list_indexes(config):
 
 
 def delete_index(config, index: Ref):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    def delete(db):
         with db.tx(True):
             assert isinstance(index(), Index), f"no such index: {index.id}"
             db.delete(index)
+
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
+        db.transact(delete, db)
     return True
 
 
@@ -430,6 +490,16 @@ def deref(config, ref):
             return db.get(ref)
 
 
+@dataclass
+class OpResult:
+    """The result of an earlier op in a batch, eg. `["OpResult", 0]` in JSON."""
+
+    index: int
+
+
+DATA_TYPE[OpResult.__name__] = OpResult
+
+
 def invoke_op(f):
     _, fname = f.__name__.split("_", 1)
     if not hasattr(invoke_op, "fns"):
@@ -438,15 +508,35 @@ def invoke_op(f):
     return f
 
 
+# Ops which only read the repo.
+READ_OPS = ["get_dag", "get_names", "get_node", "get_node_value", "get_argv", "get_result", "unroll"]
+
+
 def format_ops():
     return ", ".join(sorted([*list(invoke_op.fns.keys()), *BUILTIN_FNS.keys()]))
 
 
 @invoke_op
 def op_start_fn(db, index, argv, name=None, doc=None):
+    # The adapter runs between two write transactions (unless this is part of
+    # a batch, which is atomic) so that other writers aren't blocked by it.
     with db.tx(True):
         argv = [op_put_literal(db, index, x) for x in argv]
-        return db.start_fn(index, argv=argv, name=name, doc=doc)
+        if argv[0]().datum.adapter is None:
+            return db.start_fn(index, argv=argv, name=name, doc=doc)
+        fn, cache_key, dump = db.prepare_fn(argv)
+    result = db.submit_fn(fn, cache_key, dump)
+    with db.tx(True):
+        return db.finish_fn(index, argv, cache_key, result, name=name, doc=doc)
+
+
+def is_plain(data):
+    """True if `data` contains no refs or executables, ie. put_literal stores it as-is."""
+    if isinstance(data, (list, set)):
+        return all(is_plain(x) for x in data)
+    if isinstance(data, dict):
+        return all(is_plain(x) for x in data.values())
+    return not isinstance(data, (Ref, Executable))
 
 
 @invoke_op
@@ -483,6 +573,11 @@ def op_put_literal(db, index, data, name=None, doc=None):
             return op_start_fn(db, index, [fn_, *args])
         return args
 
+    if is_plain(data):  # pack and hash it before taking the write lock
+        staged = db.stage_datum(data)
+        db.write_staged(staged)  # big blobs don't hold up other writes either
+        with db.tx(True):
+            return db.put_node(Literal(db.put_staged(staged)), index=index, name=name, doc=doc)
     with db.tx(True):
         data = maybe_to_node(data)
         if isinstance(data, Ref) and data.type == "node":
@@ -519,17 +614,21 @@ def op_get_dag(db, index, name, recurse=False):
 @invoke_op
 def op_get_names(db, index, dag: Ref = None):
     with db.tx():
+        staged = [] if dag else db.staged(index)
         dag = dag or index().dag
-        return dag().names
+        return {**dag().names, **{k: v for v, k in staged if k}}
 
 
 @invoke_op
 def op_get_node(db, index, name, dag: Ref = None):
     with db.tx():
+        staged = [] if dag else db.staged(index)
         dag = dag or index().dag
-        nodes = [x for x in dag().nodes if x.to == name]
-        if len(nodes) > 0:
-            return nodes[0]
+        if Ref(name) in dag().nodes or any(x == Ref(name) for x, _ in staged):
+            return Ref(name)
+        for node, k in reversed(staged):
+            if k == name:
+                return node
         if name not in dag().names:
             raise KeyError(f"Key {name} not in {sorted(dag().names)}")
         return dag().names[name]
@@ -571,24 +670,56 @@ def op_unroll(db, index, node):
         return unroll_datum(node().value())
 
 
-def invoke_api(config, token, data):
+def is_batch(data):
+    return isinstance(data, list) and all(isinstance(x, list) for x in data)
+
+
+def invoke_api(config, token, data, db=None):
+    """
+    Invoke a DAG builder API op, or a batch of them.
+
+    `data` is either a single `[op, args, kwargs]` triple or a list of them. A
+    batch runs in a single write transaction which is aborted if any op fails,
+    and returns the list of results. Args and kwargs of an op in a batch may
+    contain `OpResult(i)` placeholders, which are replaced with the result of
+    the i-th op of the batch.
+
+    If `db` is given (eg. a session from `dml serve`) it is used as-is and left
+    open, otherwise a Repo is opened from `config` for the duration of the call.
+    """
+
     def no_such_op(name):
         def inner(*_args, **_kwargs):
             raise ValueError(f"no such op: {name}")
 
         return inner
 
+    def invoke(db, op, args, kwargs):
+        if op in BUILTIN_FNS:
+            with db.tx(True):
+                fn = db.put_datum(Executable(f"daggerml:{op}"))
+                fn = op_put_literal(db, index, fn, name=f"daggerml:{op}")
+            return op_start_fn(db, index, [fn, *args], **kwargs)
+        return invoke_op.fns.get(op, no_such_op(op))(db, index, *args, **kwargs)
+
+    def is_result(x):
+        return isinstance(x, OpResult)
+
+    def batch(db, data):
+        results = []
+        with db.tx(True, atomic=True):
+            for op, args, kwargs in data:
+                args, kwargs = tree_map(is_result, lambda x: results[x.index], [args, kwargs])
+                results.append(invoke(db, op, args, kwargs))
+        return results
+
     tok_to = getattr(token, "to", "NONE")
     index = CheckedRef(tok_to, Index, f"invalid token: {tok_to}")
     try:
-        with Repo.from_config(config) as db:
-            op, args, kwargs = data
-            if op in BUILTIN_FNS:
-                with db.tx(True):
-                    fn = db.put_datum(Executable(f"daggerml:{op}"))
-                    fn = op_put_literal(db, index, fn, name=f"daggerml:{op}")
-                return op_start_fn(db, index, [fn, *args], **kwargs)
-            return invoke_op.fns.get(op, no_such_op(op))(db, index, *args, **kwargs)
+        with nullcontext(db) if db else Repo.from_config(config) as db:
+            if not is_batch(data):
+                return db.transact(invoke, db, *data)
+            return db.transact(batch, db, data)
     except Exception as e:
         raise Error.from_ex(e) from e
 
@@ -599,7 +730,7 @@ def invoke_api(config, token, data):
 
 
 def list_commit(config):
-    with Repo(config.REPO_PATH, head=config.BRANCHREF) as db:
+    with Repo(config.REPO_PATH, head=config.BRANCHREF, **config.REPO_OPTIONS) as db:
         with db.tx():
             result = [with_attrs(x) for x in db.commits()]
             return sorted(result, key=lambda x: x.modified, reverse=True)
@@ -609,14 +740,14 @@ def describe_commit(config, commit: Ref = None):
     kw = {}
     if commit is None:
         kw["head"] = config.BRANCHREF
-    with Repo(config.REPO_PATH, **kw) as db:
+    with Repo(config.REPO_PATH, **kw, **config.REPO_OPTIONS) as db:
         with db.tx():
             commit = commit or db.head().commit
-            return with_attrs(commit, dags=commit().tree().dags)
+            return with_attrs(commit, dags=dict(commit().tree().dags))
 
 
 def commit_log_graph(config, output="ascii"):
-    with Repo(config.REPO_PATH, user=config.USER) as db:
+    with Repo(config.REPO_PATH, user=config.USER, **config.REPO_OPTIONS) as db:
         with db.tx():
 
             def walk_names(x, head=None):
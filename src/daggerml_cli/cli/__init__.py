@@ -9,9 +9,9 @@ import jmespath
 from click import ClickException
 from tabulate import tabulate
 
-from daggerml_cli import __version__, api
+from daggerml_cli import __version__, api, db, server
 from daggerml_cli.config import Config
-from daggerml_cli.repo import REPO_TYPES, Error, Ref, from_json, to_json
+from daggerml_cli.repo import DEFAULT_HASH_ALGO, HASH_ALGOS, REPO_TYPES, Error, Ref, from_json, to_json
 from daggerml_cli.util import merge_counters, writefile
 
 logger = logging.getLogger(__name__)
@@ -108,6 +108,11 @@ def json_spec(ctx, param, value):
     help="Project directory location.",
 )
 @click.option("--debug", is_flag=True, help="Enable debug output.")
+@click.option(
+    "--socket-path",
+    type=click.Path(),
+    help="Unix socket of the `dml serve` daemon (default: CONFIG_DIR/dml.sock).",
+)
 @click.option(
     "--config-dir",
     type=click.Path(),
@@ -120,6 +125,34 @@ def json_spec(ctx, param, value):
     shell_complete=complete(api.list_branch, set_config),
     help="Specify a branch other than the project branch.",
 )
+@click.option(
+    "--durability",
+    type=click.Choice(list(db.DURABILITY)),
+    help="Durability of repo writes (default: strict).",
+)
+@click.option(
+    "--cache-durability",
+    type=click.Choice(list(db.DURABILITY)),
+    help="Durability of cache writes (default: strict).",
+)
+@click.option(
+    "--storage",
+    type=click.Choice(list(db.STORAGE)),
+    help="Storage backend of repos and caches (default: lmdb).",
+)
+@click.option("--map-growth", type=str, help='How LMDB maps grow (eg. "factor=2,headroom=0.25,max_size=1e11").')
+@click.option("--split", is_flag=True, default=None, help="Keep datums in an environment of their own in new repos.")
+@click.option("--staging", is_flag=True, default=None, help="Stage nodes put to an open dag until it is committed.")
+@click.option(
+    "--cache-compression",
+    type=click.Choice([*db.COMPRESSION, "none"]),
+    help=f"Compression of cache values (default: {db.DEFAULT_COMPRESSION}).",
+)
+@click.option(
+    "--cache-eviction",
+    type=str,
+    help='Automatic cache eviction (eg. "policy=cost,max_size=1e10,ttl=86400").',
+)
 @click.option(
     "--spec",
     help="Print command info as JSON and exit.",
@@ -137,7 +170,26 @@ def json_spec(ctx, param, value):
     },
 )
 @clickex
-def cli(ctx, config_dir, project_dir, repo, cache_path, branch, user, query, debug):
+def cli(
+    ctx,
+    config_dir,
+    project_dir,
+    repo,
+    cache_path,
+    branch,
+    user,
+    query,
+    debug,
+    socket_path,
+    durability,
+    cache_durability,
+    storage,
+    map_growth,
+    split,
+    staging,
+    cache_compression,
+    cache_eviction,
+):
     """The DaggerML command line tool."""
     set_config(ctx)
     ctx.with_resource(ctx.obj)
@@ -183,9 +235,18 @@ def api_invoke(ctx, token, data):
     API methods are invoked with the TOKEN returned by the 'dag create' command
     and JSON consisting of a serialized payload of the form:
 
-        [method, [args...] {kwargs...}]"""
+        [method, [args...] {kwargs...}]
+
+    or a list of these, which is run as a single atomic batch. Later methods in
+    a batch can refer to the result of the i-th method as ["OpResult", i].
+
+    If a `dml serve` daemon is running the request is handled by it."""
     try:
-        click.echo(to_json(api.invoke_api(ctx.obj, from_json(token), from_json(data.read().strip()))))
+        data = data.read().strip()
+        resp = server.invoke(ctx.obj, token, data)
+        if resp is None:
+            resp = to_json(api.invoke_api(ctx.obj, from_json(token), from_json(data)))
+        click.echo(resp)
     except Exception as e:
         click.echo(to_json(Error.from_ex(e)))
 
@@ -442,10 +503,16 @@ def cache_create(ctx):
 
 
 @cache_group.command(name="list")
-@clickex
-def cache_list(ctx):
-    """List cached dags."""
-    for item in api.list_cache(ctx.obj):
+@click.option("--adapter", type=str, help="Only list results of functions with this adapter.")
+@click.option("--uri", type=str, help="Only list results of functions with this uri.")
+@click.option("--after", type=str, help="Start after this cache key (eg. the last one listed).")
+@click.option("--limit", type=int, help="List at most this many items.")
+@clickex
+def cache_list(ctx, adapter, uri, after, limit):
+    """List cached dags.
+    Items are listed in cache key order from the cache's metadata index, so
+    large caches can be paged through with --after and --limit."""
+    for item in api.list_cache(ctx.obj, adapter=adapter, uri=uri, after=after, limit=limit):
         click.echo(jsdumps(item))
 
 
@@ -468,6 +535,44 @@ def cache_delete(ctx, cache_key):
         click.echo(f"Not found: {cache_key!r} in cache")
 
 
+@cache_group.command(name="evict")
+@click.option("--policy", type=click.Choice(["lru", "cost"]), help="Evict least recently used or cheapest first.")
+@click.option("--max-size", type=int, help="Evict entries until the cache holds at most this many bytes.")
+@click.option("--ttl", type=float, help="Evict entries not accessed for this many seconds.")
+@clickex
+def cache_evict(ctx, policy, max_size, ttl):
+    """Evict cached items.
+    Settings which are not given are taken from --cache-eviction (eg.
+    "policy=cost,max_size=1e10,ttl=86400"), which also enables automatic
+    eviction whenever a result is added to the cache. The evicted cache keys
+    are printed."""
+    click.echo(jsdumps(api.evict_cache(ctx.obj, policy=policy, max_size=max_size, ttl=ttl), ctx.obj))
+
+
+@cache_group.command(name="stats")
+@click.option("--output", type=click.Choice(["table", "json"]), default="table", help="Output format.")
+@click.option("--file", type=click.Path(dir_okay=False), help="Also write the statistics to FILE as JSON.")
+@clickex
+def cache_stats(ctx, output, file):
+    """Print function call statistics.
+
+    For each function (by adapter and uri) submitted to the cache: hits,
+    misses (adapter calls), polls (of async adapters still running), waits for
+    an identical call already in flight, failed calls, seconds spent waiting
+    and in the adapter, and bytes of results stored. A low hit rate can point
+    to a function with a poor cache key (eg. one that includes a timestamp).
+    """
+    stats = api.stats_cache(ctx.obj)
+    if file:
+        writefile(json.dumps(stats, indent=2), os.path.abspath(file))
+    if output == "json":
+        click.echo(jsdumps(stats, ctx.obj))
+    else:
+        headers = ["adapter", "uri", *db.STATS, "hit_rate"]
+        summary = [[x[k] for k in headers] for x in stats]
+        click.echo(tabulate(summary, headers=headers, tablefmt="plain", floatfmt=".3f"))
+
+
 @cache_group.command(name="put")
 @click.argument("dag_id", type=str)
 @clickex
@@ -566,11 +671,17 @@ def repo_group(ctx):
 
 
 @click.argument("name")
+@click.option(
+    "--hash-algo",
+    type=click.Choice(sorted(HASH_ALGOS)),
+    default=DEFAULT_HASH_ALGO,
+    help="Hash algorithm used to address objects.",
+)
 @repo_group.command(name="create")
 @clickex
-def repo_create(ctx, name):
+def repo_create(ctx, name, hash_algo):
     """Create a new repository."""
-    api.create_repo(ctx.obj, name)
+    api.create_repo(ctx.obj, name, hash_algo=hash_algo)
     click.echo(f"Created repository: {name}")
 
 
@@ -592,6 +703,19 @@ def repo_copy(ctx, name):
     click.echo(f"Copied repository: {ctx.obj.REPO} -> {name}")
 
 
+@click.argument("algo", type=click.Choice(sorted(HASH_ALGOS)))
+@repo_group.command(name="migrate-hash")
+@clickex
+def repo_migrate_hash(ctx, algo):
+    """Re-address all objects with hash algorithm ALGO.
+    Every object is rewritten with its new id and heads and indexes are
+    updated to match, in a single transaction. Cache keys are computed with
+    the repo's hash algorithm too, so previously cached function results will
+    not be found by this repo after migrating."""
+    migrated = api.migrate_hash_repo(ctx.obj, algo)
+    click.echo(f"Migrated {sum(migrated.values())} objects to: {algo}")
+
+
 @repo_group.command(name="list")
 @clickex
 def repo_list(ctx):
@@ -617,19 +741,37 @@ def repo_deleted(ctx, remove=None):
 
 
 @repo_group.command(name="gc")
+@click.option("--limit", type=int, help="Visit at most this many candidate objects.")
 @clickex
-def repo_gc(ctx):
+def repo_gc(ctx, limit=None):
     """Delete unreachable objects.
     A summary table of objects deleted by type is printed. Resource objects
     which were deleted can be accessed via `dml repo deleted` so that their
-    associated external resources can be cleaned up."""
-    deleted, remaining = api.gc_repo(ctx.obj)
+    associated external resources can be cleaned up. Collection is incremental,
+    so with --limit it can be run repeatedly in short slices."""
+    deleted, remaining = api.gc_repo(ctx.obj, limit=limit)
     summary = [[k, *v] for k, v in merge_counters(deleted, remaining).items()]
     summary = sorted(summary, key=lambda x: x[0])
     headers = ["object", "deleted", "remaining"]
     click.echo(tabulate(summary, headers=headers, tablefmt="plain"))
 
 
+###############################################################################
+# SERVE #######################################################################
+###############################################################################
+
+
+@cli.command(name="serve")
+@clickex
+def cli_serve(ctx):
+    """Run the DAG builder API daemon.
+    Listens on a unix socket (see --socket-path) and keeps repo and cache
+    environments open between requests. While it is running `dml api invoke`
+    sends its requests to the daemon instead of opening the repo itself."""
+    click.echo(f"Listening on: {ctx.obj.SOCKET_PATH}", err=True)
+    server.serve(ctx.obj.SOCKET_PATH)
+
+
 ###############################################################################
 # STATUS ######################################################################
 ###############################################################################
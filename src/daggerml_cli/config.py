@@ -3,6 +3,7 @@ from dataclasses import dataclass, field, fields, replace
 from functools import wraps
 from typing import Optional
 
+from daggerml_cli.db import Eviction, MapGrowth
 from daggerml_cli.repo import Ref
 from daggerml_cli.util import readfile, writefile
 
@@ -11,6 +12,18 @@ class ConfigError(RuntimeError):
     pass
 
 
+SETTINGS = [
+    "durability",
+    "cache_durability",
+    "storage",
+    "map_growth",
+    "split",
+    "staging",
+    "cache_compression",
+    "cache_eviction",
+]
+
+
 def priv_name(x):
     return f"_{x.upper()}"
 
@@ -62,6 +75,16 @@ class Config:
     _QUERY: Optional[str] = None
     _writes: list = field(default_factory=list)
     _CACHE_PATH: Optional[str] = None
+    _SOCKET_PATH: Optional[str] = None
+    # storage settings (see REPO_OPTIONS and CACHE_OPTIONS), None for the defaults
+    _DURABILITY: Optional[str] = None
+    _CACHE_DURABILITY: Optional[str] = None
+    _STORAGE: Optional[str] = None
+    _MAP_GROWTH: Optional[str] = None
+    _SPLIT: Optional[bool] = None
+    _STAGING: Optional[bool] = None
+    _CACHE_COMPRESSION: Optional[str] = None
+    _CACHE_EVICTION: Optional[str] = None
 
     @classmethod
     def new(cls, **kw):
@@ -107,6 +130,38 @@ class Config:
     def CACHE_PATH(self):
         return self._CACHE_PATH
 
+    @config_property
+    def SOCKET_PATH(self):
+        return self._SOCKET_PATH or os.path.join(self.CONFIG_DIR, "dml.sock")
+
+    @property
+    def SETTINGS(self):
+        """The storage settings by option name, as given (eg. sent to `dml serve`)."""
+        return {k: getattr(self, priv_name(k)) for k in SETTINGS}
+
+    @property
+    def REPO_OPTIONS(self):
+        """Keyword arguments of the Repos opened with this config."""
+        return {
+            "durability": self._DURABILITY,
+            "storage": self._STORAGE,
+            "map_growth": MapGrowth.parse(self._MAP_GROWTH) if self._MAP_GROWTH else None,
+            "split": self._SPLIT,
+            "staging": self._STAGING,
+            "cache_options": self.CACHE_OPTIONS,
+        }
+
+    @property
+    def CACHE_OPTIONS(self):
+        """Keyword arguments of the Caches opened with this config."""
+        return {
+            "durability": self._CACHE_DURABILITY,
+            "storage": self._STORAGE,
+            "map_growth": MapGrowth.parse(self._MAP_GROWTH) if self._MAP_GROWTH else None,
+            "compression": self._CACHE_COMPRESSION,
+            "eviction": Eviction.parse(self._CACHE_EVICTION) if self._CACHE_EVICTION else None,
+        }
+
     @config_property
     def BRANCHREF(self):
         return Ref(f"head/{self.BRANCH}")
@@ -3,18 +3,60 @@ import logging
 import math
 import os
 import shutil
+import socket
 import subprocess
+import threading
+import time
+import zlib
+from bisect import bisect_left
 from contextlib import contextmanager
-from dataclasses import InitVar, dataclass, field
-from typing import Optional, cast
+from copy import copy
+from dataclasses import InitVar, dataclass, field, fields
+from typing import Optional
+from uuid import uuid4
 
 import lmdb
 
 from daggerml_cli.util import makedirs
 
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
 logger = logging.getLogger(__name__)
 MAP_SIZE_MIN = 512 * 1024**2  # Minimum 512MB
 MAP_SIZE_MAX = 128 * 1024**3  # Maximum 128GB
+# LMDB environment flags by durability profile: "strict" syncs every commit,
+# "fast" leaves flushing to the OS (a crash can lose recent commits, eg. for
+# scratch repos in CI) and "readonly" is for reporting jobs.
+DURABILITY = {
+    "strict": {"sync": True, "metasync": True, "writemap": False, "map_async": False, "readahead": True, "lock": True},
+    "fast": {"sync": False, "metasync": False, "writemap": True, "map_async": True, "readahead": True, "lock": True},
+    "readonly": {"readonly": True, "readahead": False, "lock": True},
+}
+DEFAULT_DURABILITY = "strict"
+DEFAULT_STORAGE = "lmdb"
+CACHE_DBS = [
+    "leases",  # cache keys -> the in-flight call computing them (see Cache.submit)
+    "pending",  # cache keys -> when the calls of an async adapter still running started (see Cache._release)
+    "entries",  # cache keys -> their metadata (see Cache.list), recompute cost and last access (see Eviction)
+    "meta",  # cache-wide eviction state: total size, GreedyDual clock and next TTL sweep
+    "stats",  # [adapter, uri] -> call counters (see Cache.stats)
+]
+# Compressors of cache values by name: (compress, decompress) functions.
+COMPRESSION = {"zlib": (zlib.compress, zlib.decompress)}
+if zstandard is not None:
+    COMPRESSION["zstd"] = (
+        lambda x: zstandard.ZstdCompressor().compress(x),
+        lambda x: zstandard.ZstdDecompressor().decompress(x),
+    )
+DEFAULT_COMPRESSION = "zstd" if zstandard is not None else "zlib"
+COMPRESS_THRESHOLD = 4096  # bytes below which cache values are stored as is
+LIST_PAGE = 1000  # entries per page when iterating over a cache
+STATS = ["hits", "misses", "polls", "waits", "errors", "wait_time", "wall_time", "bytes"]
+LEASE_TTL = 3600.0  # seconds after which a call's lease on its cache key is considered abandoned
+LEASE_POLL = (0.05, 1.0)  # min and max seconds between checks of another call's lease
 
 
 class CacheError(Exception):
@@ -38,18 +80,269 @@ def serialize_resource(x):
         }
 
 
-def dbenv(path, db_types, **kw):
+def compress_value(data, algo, threshold=COMPRESS_THRESHOLD):
+    """
+    Compress a cache value with `algo` (see COMPRESSION, or "none") if it is
+    at least `threshold` bytes and compressing makes it smaller. Compressed
+    values are flagged by a b"\\0<algo>\\0" prefix (dumps never start with NUL).
+    """
+    if algo == "none" or len(data) < threshold:
+        return data
+    packed = b"\0" + algo.encode() + b"\0" + COMPRESSION[algo][0](data)
+    return packed if len(packed) < len(data) else data
+
+
+def decompress_value(data):
+    """The original of a cache value stored by `compress_value`."""
+    if not data.startswith(b"\0"):
+        return data
+    algo, payload = data[1:].split(b"\0", 1)
+    if algo.decode() not in COMPRESSION:
+        raise CacheError(f"cache value compressed with unavailable algorithm: {algo.decode()}")
+    return COMPRESSION[algo.decode()][1](payload)
+
+
+def check_compression(name):
+    """Return the cache compression `name` (see COMPRESSION), if it is one."""
+    if name not in [*COMPRESSION, "none"]:
+        msg = f"unknown cache compression: {name!r} (expected one of {', '.join(COMPRESSION)}, none)"
+        raise ValueError(msg)
+    return name
+
+
+def durability_flags(profile=None):
+    """The LMDB flags of a durability profile (default: strict)."""
+    profile = profile or DEFAULT_DURABILITY
+    if profile not in DURABILITY:
+        msg = f"unknown durability profile: {profile!r} (expected one of {', '.join(DURABILITY)})"
+        raise ValueError(msg)
+    return DURABILITY[profile]
+
+
+class MemoryStore:
+    """The databases of an in-memory environment, shared by the environments opened on its path."""
+
+    stores = {}
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.data = {None: {}}  # db name -> {key: value}, replaced (not mutated) on commit
+        self.write_lock = threading.Lock()
+        self.map_size = MAP_SIZE_MIN
+
+    @classmethod
+    def open(cls, path, create=True):
+        with cls.lock:
+            for k in [k for k in cls.stores if not os.path.isdir(k)]:
+                del cls.stores[k]  # a store goes with its directory
+            if path not in cls.stores:
+                if not create:
+                    raise lmdb.Error(f"{path}: No such file or directory")
+                makedirs(path)
+                cls.stores[path] = cls()
+            return cls.stores[path]
+
+    @classmethod
+    def exists(cls, path):
+        return path in cls.stores and os.path.isdir(path)
+
+
+class MemoryCursor:
+    def __init__(self, txn, db):
+        self.txn = txn
+        self.db = db
+        self.keys = sorted(txn._data[db])
+        self.pos = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def __iter__(self):
+        return self.iternext()
+
+    def iternext(self, keys=True, values=True):
+        self.pos = self.pos or 0
+        while self.pos < len(self.keys):
+            k = self.keys[self.pos]
+            v = self.txn._data[self.db][k]
+            yield (k, v) if keys and values else (k if keys else v)
+            self.pos += 1
+
+    def set_range(self, key):
+        self.pos = bisect_left(self.keys, bytes(key))
+        return self.pos < len(self.keys)
+
+    def key(self):
+        return self.keys[self.pos] if self.pos is not None and self.pos < len(self.keys) else b""
+
+    def value(self):
+        return self.txn._data[self.db][self.key()] if self.key() else b""
+
+    def delete(self):
+        if not self.key():
+            return False
+        self.txn.delete(self.keys.pop(self.pos), db=self.db)
+        return True
+
+
+class MemoryTransaction:
+    def __init__(self, env, write=False, parent=None):
+        self.env = env
+        self.write = write
+        self.parent = parent
+        self._copied = set()  # the dbs this transaction has copied (to write to)
+        if parent is not None:
+            self._data = dict(parent._data)
+        elif write:
+            env.store.write_lock.acquire()  # one writer at a time, as with LMDB
+            self._data = dict(env.store.data)
+        else:
+            self._data = env.store.data
+        self._done = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        self.abort() if exc_type else self.commit()
+
+    def _writable(self, db):
+        if not self.write:
+            raise lmdb.ReadonlyError("mdb_put: Permission denied")
+        if db not in self._copied:
+            self._data[db] = dict(self._data[db])
+            self._copied.add(db)
+        return self._data[db]
+
+    def get(self, key, default=None, db=None):
+        return self._data[db].get(bytes(key), default)
+
+    def put(self, key, value, db=None, **_):
+        self._writable(db)[bytes(key)] = bytes(value)
+        return True
+
+    def delete(self, key, value=b"", db=None):
+        data = self._writable(db)
+        return data.pop(bytes(key), None) is not None
+
+    def drop(self, db, delete=True):
+        self._writable(db).clear()
+
+    def stat(self, db=None):
+        return {"entries": len(self._data[db]), "psize": 4096}
+
+    def cursor(self, db=None):
+        return MemoryCursor(self, db)
+
+    def commit(self):
+        if self._done:
+            return
+        self._done = True
+        if self.parent is not None:
+            self.parent._data = self._data
+            self.parent._copied |= self._copied
+        elif self.write:
+            self.env.store.data = self._data
+            self.env.store.write_lock.release()
+
+    def abort(self):
+        if self._done:
+            return
+        self._done = True
+        if self.parent is None and self.write:
+            self.env.store.write_lock.release()
+
+
+class MemoryEnvironment:
+    """
+    An in-memory stand-in for `lmdb.Environment`, implementing the part of the
+    py-lmdb API that Repo and Cache use (see `open_env`). Its data lives as
+    long as the process (and the directory at `path`), so it is meant for
+    tests and short-lived pipelines.
+    """
+
+    def __init__(self, path, readonly=False, **kw):
+        self.path = path
+        self.store = MemoryStore.open(path, create=not readonly)
+        self._flags = {"readonly": readonly, "writemap": False, **kw}
+
+    def open_db(self, key, create=True, **_):
+        if key not in self.store.data:
+            if not create:
+                raise lmdb.NotFoundError(f"{key.decode()}: MDB_NOTFOUND: No matching key/data pair found")
+            with self.begin(write=True) as txn:
+                txn._data[key], txn._copied = {}, {*txn._copied, key}
+        return key
+
+    def begin(self, write=False, parent=None, **_):
+        if write and self._flags["readonly"]:
+            raise lmdb.ReadonlyError("mdb_txn_begin: Permission denied")
+        return MemoryTransaction(self, write=write or parent is not None, parent=parent)
+
+    def info(self):
+        return {"map_size": self.store.map_size, "last_pgno": 0}
+
+    def stat(self):
+        return {"psize": 4096, "entries": len(self.store.data[None])}
+
+    def set_mapsize(self, map_size):
+        self.store.map_size = map_size
+
+    def flags(self):
+        return dict(self._flags)
+
+    def copy(self, path, **_):
+        MemoryStore.open(path).data = self.store.data
+
+    def close(self):
+        pass
+
+
+# Storage backends by name: functions opening an environment like `lmdb.open`
+# and telling whether one exists at a path.
+STORAGE = {
+    "lmdb": (lmdb.open, lambda path: os.path.exists(os.path.join(path, "data.mdb"))),
+    "memory": (MemoryEnvironment, MemoryStore.exists),
+}
+
+
+def storage_backend(name=None):
+    """The (open, exists) functions of a storage backend (default: lmdb)."""
+    name = name or DEFAULT_STORAGE
+    if name not in STORAGE:
+        msg = f"unknown storage backend: {name!r} (expected one of {', '.join(STORAGE)})"
+        raise ValueError(msg)
+    return STORAGE[name]
+
+
+def open_env(path, storage=None, **kw):
+    """Open the environment at `path` with a storage backend (see STORAGE)."""
+    return storage_backend(storage)[0](path, **kw)
+
+
+def dbenv(path, db_types, storage=None, **kw):
     i = 0
     while True:
         try:
-            env = lmdb.open(path, max_dbs=len(db_types) + 1, **kw)
+            env = open_env(path, storage, max_dbs=len(db_types) + 1, **kw)
             break
         except Exception:
             logger.exception("error while opening lmdb...")
             if i > 2:
                 raise
             i += 1
-    return env, {k: env.open_db(f"db/{k}".encode()) for k in db_types}
+    if not kw.get("readonly"):
+        return env, {k: env.open_db(f"db/{k}".encode()) for k in db_types}
+    dbs = {}
+    for k in db_types:  # databases can't be created in a read only env
+        try:
+            dbs[k] = env.open_db(f"db/{k}".encode(), create=False)
+        except lmdb.NotFoundError:
+            pass
+    return env, dbs
 
 
 def get_map_size(path=None, env=None):
@@ -69,29 +362,235 @@ def get_map_size(path=None, env=None):
     return map_size
 
 
+def parse_spec(cls, spec, what):
+    """
+    Parse a "k=v,..." style spec into an instance of the dataclass `cls`.
+
+    Values are converted to the type of the field they set, and `what` names
+    the settings in the error raised for an unknown key.
+    """
+    types = {x.name: getattr(x.type, "__name__", x.type) for x in fields(cls)}
+    conv = {"str": str, "int": lambda x: int(float(x)), "float": float}
+    kw = dict(x.split("=", 1) for x in (spec or "").replace(" ", "").split(",") if x)
+    for k in kw:
+        if k not in types:
+            raise ValueError(f"unknown {what} setting: {k}")
+    return cls(**{k: conv[types[k]](v) for k, v in kw.items()})
+
+
+@dataclass
+class MapGrowth:
+    """
+    How an LMDB map grows.
+
+    The map is grown by `factor` (up to `max_size`) when a write runs out of
+    space, or proactively before a write when less than `headroom` (a
+    fraction of the map) is free.
+    """
+
+    factor: float = 2.0
+    headroom: float = 0.25
+    max_size: int = MAP_SIZE_MAX
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a "factor=2,headroom=0.25,max_size=1e11" style spec (eg. of --map-growth)."""
+        return parse_spec(cls, spec, "map growth")
+
+    def next_size(self, size):
+        new_size = min(int(size * self.factor), self.max_size)
+        if new_size <= size:
+            msg = f"LMDB map size is already at maximum: {size}"
+            raise RuntimeError(msg)
+        return new_size
+
+    def wants_growth(self, env):
+        info = env.info()
+        used = (info["last_pgno"] + 1) * env.stat()["psize"]
+        return used > info["map_size"] * (1 - self.headroom)
+
+
+class Resizer:
+    """
+    Grows an environment's map according to a MapGrowth policy.
+
+    LMDB only allows resizing while no transactions are active in the process,
+    so transactions are registered via `active`, and `grow` (or `adopt`) waits
+    for them to finish before resizing. Meanwhile new registrations wait for
+    the resize, so that a steady stream of transactions can't starve it, but
+    those of threads which are already registered don't (they would deadlock).
+    """
+
+    def __init__(self, env, growth):
+        self.env = env
+        self.growth = growth
+        self._cond = threading.Condition()
+        self._active = 0
+        self._growing = 0  # resizes waiting for the active transactions
+        self._local = threading.local()
+
+    @contextmanager
+    def active(self):
+        depth = getattr(self._local, "depth", 0)
+        with self._cond:
+            if not depth:
+                self._cond.wait_for(lambda: not self._growing)
+            self._active += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def _resizing(self):
+        # Holds the lock once no transactions are active, holding off new ones while waiting.
+        with self._cond:
+            self._growing += 1
+            try:
+                self._cond.wait_for(lambda: self._active == 0)
+                yield
+            finally:
+                self._growing -= 1
+                self._cond.notify_all()
+
+    def grow(self, force=False):
+        if not (force or self.growth.wants_growth(self.env)):
+            return
+        with self._resizing():
+            if force or self.growth.wants_growth(self.env):
+                map_size = self.growth.next_size(self.env.info()["map_size"])
+                logger.info("Growing LMDB map_size to %r", map_size)
+                self.env.set_mapsize(map_size)
+
+    def adopt(self):
+        # Adopts the map size another process grew the map to, which LMDB
+        # reports with lmdb.MapResizedError when a transaction begins.
+        with self._resizing():
+            self.env.set_mapsize(0)
+
+
+@dataclass
+class Eviction:
+    """
+    Which entries a Cache evicts (see Cache.evict).
+
+    Entries not accessed for `ttl` seconds (0 for no limit) are evicted, and
+    then more until the cache holds at most `max_size` bytes (0 for no limit).
+    Policy "lru" evicts the least recently used entries first. Policy "cost"
+    is GreedyDual: an entry's priority is `clock + cost / size` as of its last
+    access, where `cost` is the seconds its function call took, and `clock`
+    rises to the priority of each evicted entry. Entries that are cheap to
+    recompute, large or long unused go first.
+
+    Automatic eviction (on writes to the cache) frees `headroom` (a fraction
+    of `max_size`) beyond the limit, so that not every write scans the cache.
+    """
+
+    policy: str = "lru"
+    max_size: int = 0
+    ttl: float = 0.0
+    headroom: float = 0.1
+
+    def __post_init__(self):
+        if self.policy not in ["lru", "cost"]:
+            msg = f"unknown eviction policy: {self.policy!r} (expected one of lru, cost)"
+            raise ValueError(msg)
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a "policy=cost,max_size=1e10,ttl=86400" style spec (eg. of --cache-eviction)."""
+        return parse_spec(cls, spec, "eviction")
+
+    @property
+    def bounded(self):
+        return bool(self.max_size or self.ttl)
+
+    def select(self, entries, now, clock=0.0, target=None):
+        """
+        The keys to evict from `entries` (key -> entry dict) at time `now`,
+        down to `target` bytes (default: `max_size`), and the new clock.
+        """
+        target = self.max_size if target is None else target
+        keys = [k for k, x in entries.items() if self.ttl and now - x["atime"] > self.ttl]
+        total = sum(x["size"] for x in entries.values()) - sum(entries[k]["size"] for k in keys)
+        if self.max_size and total > target:
+            order = "atime" if self.policy == "lru" else "priority"
+            for k in sorted(set(entries) - set(keys), key=lambda k: (entries[k][order], k)):
+                if total <= target:
+                    break
+                keys.append(k)
+                total -= entries[k]["size"]
+                if self.policy == "cost":
+                    clock = max(clock, entries[k]["priority"])
+        return keys, clock
+
+
 @dataclass
 class Cache:
     path: str
-    env: Optional[lmdb.Environment] = field(init=False, default=None)
+    env: Optional[lmdb.Environment] = field(init=False, default=None)  # or a MemoryEnvironment
     create: InitVar[bool] = False
+    durability: Optional[str] = None  # defaults to strict (see DURABILITY)
+    storage: Optional[str] = None  # defaults to lmdb (see STORAGE)
+    lease_ttl: float = LEASE_TTL
+    eviction: Optional[Eviction] = None  # defaults to no eviction (see Eviction)
+    compression: Optional[str] = None  # defaults to zstd if installed, else zlib
+    compress_threshold: int = COMPRESS_THRESHOLD
+    map_growth: Optional[MapGrowth] = None  # defaults to MapGrowth()
+    dbs: dict = field(init=False, default_factory=dict)
 
     def __post_init__(self, create=False):
+        self.compression = check_compression(self.compression or DEFAULT_COMPRESSION)
+        self.eviction = self.eviction or Eviction()
         if create:
             assert not os.path.exists(self.path), f"cache exists: {self.path}"
             makedirs(self.path)
+        flags = durability_flags(self.durability)
         for _ in range(3):
             try:
-                self.env = lmdb.open(self.path, max_dbs=1, map_size=get_map_size(self.path))
+                map_size = get_map_size(self.path)
+                self.env, self.dbs = dbenv(self.path, CACHE_DBS, self.storage, map_size=map_size, **flags)
                 break
             except lmdb.Error as e:
                 logger.exception("LMDB error while opening environment: %s", e)
                 if _ == 2:
                     raise
+        self.map_growth = self.map_growth or MapGrowth()
+        self._resizer = Resizer(self.env, self.map_growth)
+        if not flags.get("readonly") and not self._resize_call(lambda tx: self._meta(tx, "indexed")):
+            self._resize_call(self._index, write=True)
+
+    def session(self, *, compression=None, eviction=None):
+        """
+        Create a Cache that shares this cache's open environment, but with
+        its own compression and eviction settings (eg. those of a `dml serve`
+        request). Closing the environment is left to the original cache.
+        """
+        result = copy(self)
+        result.compression = check_compression(compression or self.compression)
+        result.eviction = eviction or self.eviction
+        return result
 
     @contextmanager
     def tx(self, write=False):
-        with self.env.begin(write=write) as tx:
-            yield tx
+        # Transactions are registered with the resizer, so that growing the map
+        # waits for those of other threads sharing the cache (eg. `dml serve`).
+        # A map grown by another process meanwhile is adopted before beginning.
+        while True:
+            with self._resizer.active():
+                try:
+                    tx = self.env.begin(write=write)
+                except lmdb.MapResizedError:
+                    tx = None
+                if tx is not None:
+                    with tx:
+                        yield tx
+                    return
+            self._resizer.adopt()
 
     def _resize_call(self, func, write=False):
         while True:
@@ -99,54 +598,182 @@ class Cache:
                 with self.tx(write=write) as tx:
                     return func(tx)
             except lmdb.MapFullError:
-                self.env.set_mapsize(get_map_size(env=self.env))
+                self._resizer.grow(force=True)
 
     def get(self, key: str) -> Optional[str]:
-        def inner(tx):
-            data = tx.get(key.encode())
-            if data is not None:
-                data = data.decode()
-            return data
+        data = self._resize_call(lambda tx: tx.get(key.encode()))
+        if data is not None:
+            data = decompress_value(bytes(data)).decode()
+        return data
 
-        return self._resize_call(inner)
-
-    def put(self, key, value, old_value=None):
+    def put(self, key, value, old_value=None, fn=None):
         def inner(tx):
             old_val = tx.get(key.encode())
-            if old_val != old_value:
+            if (old_val if old_val is None else decompress_value(bytes(old_val)).decode()) != old_value:
                 raise CacheError(f"Cache key {key!r} failed the value check")
-            data = value.encode()
-            tx.put(key.encode(), data)
+            self._store(tx, key.encode(), value.encode(), fn)
+            self._auto_evict(tx)
 
         self._resize_call(inner, write=True)
 
     def delete(self, key):
         def inner(tx):
-            return tx.delete(key.encode())
+            return self._remove(tx, key.encode())
+
+        return self._resize_call(inner, write=True)
+
+    def _meta(self, tx, name, value=None):
+        if value is not None:
+            tx.put(name.encode(), json.dumps(value).encode(), db=self.dbs["meta"])
+            return value
+        value = tx.get(name.encode(), db=self.dbs["meta"])
+        return 0 if value is None else json.loads(bytes(value))
+
+    def _touch(self, tx, key, size, cost=None, **meta):
+        # Records an access to the entry at `key` (of `size` bytes), and how
+        # long computing it took and its metadata if it was just stored.
+        old = tx.get(key, db=self.dbs["entries"])
+        entry = json.loads(bytes(old)) if old is not None else {"size": 0, "cost": 0.0}
+        self._meta(tx, "size", self._meta(tx, "size") + size - entry["size"])
+        entry.update(meta, size=size)
+        entry["cost"] = entry["cost"] if cost is None else cost
+        entry["atime"] = time.time()
+        entry["priority"] = self._meta(tx, "clock") + entry["cost"] / max(size, 1)
+        tx.put(key, json.dumps(entry).encode(), db=self.dbs["entries"])
+
+    def _store(self, tx, key, data, fn=None, cost=None):
+        # Stores a value (compressed, see `compression`) and its metadata, and
+        # returns the number of bytes stored.
+        stored = compress_value(data, self.compression, self.compress_threshold)
+        tx.put(key, stored)
+        fn = {"adapter": fn.adapter, "uri": fn.uri} if fn is not None else {"adapter": None, "uri": None}
+        self._touch(tx, key, len(stored), cost, **summarize(data), **fn, created=time.time())
+        return len(stored)
+
+    def _index(self, tx):
+        # Adds metadata for the entries stored before there was any (once).
+        if self._meta(tx, "indexed"):
+            return
+        size = 0
+        with tx.cursor() as cursor:  # one value at a time: writing to the entries db leaves the cursor alone
+            for key, val in cursor:
+                key, val = bytes(key), bytes(val)
+                if key.startswith(b"db/"):  # the named databases
+                    continue
+                old = tx.get(key, db=self.dbs["entries"])
+                entry = json.loads(bytes(old)) if old is not None else {"cost": 0.0, "atime": 0.0, "priority": 0.0}
+                summary = summarize(decompress_value(val))
+                entry = {"adapter": None, "uri": None, "created": 0.0, **entry, **summary, "size": len(val)}
+                tx.put(key, json.dumps(entry).encode(), db=self.dbs["entries"])
+                size += len(val)
+        self._meta(tx, "size", size)
+        self._meta(tx, "indexed", True)
+
+    def _remove(self, tx, key):
+        entry = tx.get(key, db=self.dbs["entries"])
+        if entry is not None:
+            self._meta(tx, "size", max(self._meta(tx, "size") - json.loads(bytes(entry))["size"], 0))
+            tx.delete(key, db=self.dbs["entries"])
+        tx.delete(key, db=self.dbs["pending"])
+        return tx.delete(key)
+
+    def _evict(self, tx, policy, now, target=None):
+        # Only the metadata is read: every value has an entry (see `_index`).
+        with tx.cursor(db=self.dbs["entries"]) as cursor:
+            entries = {bytes(k): json.loads(bytes(v)) for k, v in cursor}
+        keys, clock = policy.select(entries, now, self._meta(tx, "clock"), target)
+        for key in keys:
+            tx.delete(key, db=self.dbs["entries"])
+            tx.delete(key)
+        self._meta(tx, "size", sum(x["size"] for x in entries.values()) - sum(entries[k]["size"] for k in keys))
+        self._meta(tx, "clock", clock)
+        self._meta(tx, "sweep", now + policy.ttl / 10)
+        return sorted(x.decode() for x in keys)
+
+    def _auto_evict(self, tx):
+        policy, now = self.eviction, time.time()
+        if policy.ttl and now >= self._meta(tx, "sweep"):
+            self._evict(tx, policy, now)
+        if policy.max_size and self._meta(tx, "size") > policy.max_size:
+            self._evict(tx, policy, now, target=int(policy.max_size * (1 - policy.headroom)))
+
+    def evict(self, policy=None):
+        """
+        Evict entries from the cache.
+
+        Parameters
+        ----------
+        policy : Eviction, optional
+            What to evict (default: the cache's `eviction` policy).
+
+        Returns
+        -------
+        list of str
+            The evicted cache keys.
+        """
+        policy = policy or self.eviction
+
+        def inner(tx):
+            return self._evict(tx, policy, time.time())
 
         return self._resize_call(inner, write=True)
 
-    def list(self):
+    def list(self, adapter=None, uri=None, after=None, limit=None):
+        """
+        List cache entries by key, without reading their values.
+
+        Parameters
+        ----------
+        adapter, uri : str, optional
+            Only list the results of functions with this adapter or uri.
+        after : str, optional
+            Start after this cache key (eg. the last one of the previous page).
+        limit : int, optional
+            List at most this many entries.
+
+        Returns
+        -------
+        list of dict
+            With the "cache_key", "error" (True if the result is an error),
+            "dag_id" (of the result), "adapter" and "uri" (of the function,
+            if known), "size" (bytes) and "created" (unix time) of each entry.
+        """
+        keys = ["error", "dag_id", "adapter", "uri", "size", "created"]
+
         def inner(tx):
-            with tx.cursor() as cursor:
-                return sorted(
-                    [cast(dict, self.describe(key.decode(), cast(bytes, val).decode())) for key, val in cursor],
-                    key=lambda x: x["cache_key"],
-                )
+            result = []
+            with tx.cursor(db=self.dbs["entries"]) as cursor:
+                if after is not None and not cursor.set_range(after.encode() + b"\0"):
+                    return result
+                for key, val in cursor:
+                    if limit is not None and len(result) >= limit:
+                        break
+                    entry = json.loads(bytes(val))
+                    if adapter is not None and entry["adapter"] != adapter:
+                        continue
+                    if uri is not None and entry["uri"] != uri:
+                        continue
+                    result.append({"cache_key": bytes(key).decode(), **{k: entry[k] for k in keys}})
+            return result
 
         return self._resize_call(inner)
 
     def __iter__(self):
-        return iter(self.list())
+        after = None
+        while True:
+            page = self.list(after=after, limit=LIST_PAGE)
+            yield from page
+            if len(page) < LIST_PAGE:
+                return
+            after = page[-1]["cache_key"]
 
     def describe(self, key, val=None):
         val = val or self.get(key)
         if val is None:
             return None
-        js = cast(list, json.loads(val))
-        if js[0] == "Error":
-            return {"cache_key": key, "error": True, "data": None, "dag_id": None}
-        return {"cache_key": key, "error": False, "data": val, "dag_id": js[-1][1][1]}
+        summary = summarize(val)
+        data = None if summary["error"] else val
+        return {"cache_key": key, "error": summary["error"], "data": data, "dag_id": summary["dag_id"]}
 
     def _close(self):
         if self.env is not None:
@@ -164,12 +791,115 @@ class Cache:
             logger.error("Exception occurred: %s", exc_value, exc_info=True)
         return False
 
-    def submit(self, fn, cache_key, dump):
-        # all in one transaction to avoid race conditions and muitiple calls to adapter
-        with self.tx(True) as tx:
+    def _count(self, tx, fn, **counts):
+        key = json.dumps([fn.adapter, fn.uri]).encode()
+        old = tx.get(key, db=self.dbs["stats"])
+        stats = json.loads(bytes(old)) if old is not None else {}
+        stats = {k: stats.get(k, 0) + counts.get(k, 0) for k in STATS}
+        tx.put(key, json.dumps(stats).encode(), db=self.dbs["stats"])
+
+    def _claim(self, cache_key, fn=None, waited=None):
+        # Returns the cached value (as stored), or else takes out a lease on the key (if
+        # no live call holds one) and returns its id, or else None. With `fn`
+        # the outcome is counted (see `stats`), `waited` being the seconds
+        # spent waiting for another call's lease so far (None if none yet).
+        def inner(tx):
+            count = self._count if fn is not None else lambda *_, **__: None
             cached_val = tx.get(cache_key.encode())
             if cached_val:
-                return cast(bytes, cached_val).decode()
+                self._touch(tx, cache_key.encode(), len(cached_val))
+                count(tx, fn, hits=1, wait_time=waited or 0)
+                return bytes(cached_val), None
+            lease = tx.get(cache_key.encode(), db=self.dbs["leases"])
+            if lease is not None and not lease_expired(json.loads(bytes(lease))):
+                count(tx, fn, waits=int(waited is None))
+                return None, None
+            lease = {"id": uuid4().hex, "pid": os.getpid(), "host": socket.gethostname()}
+            lease["expires"] = time.time() + self.lease_ttl
+            tx.put(cache_key.encode(), json.dumps(lease).encode(), db=self.dbs["leases"])
+            polling = tx.get(cache_key.encode(), db=self.dbs["pending"]) is not None  # an async adapter
+            count(tx, fn, **{"polls" if polling else "misses": 1}, wait_time=waited or 0)
+            return None, lease["id"]
+
+        return self._resize_call(inner, write=True)
+
+    def _release(self, cache_key, lease_id, resp=None, cost=None, fn=None):
+        # Stores the result `resp` of a call (None if it failed, empty if its
+        # async adapter is still running), which took `cost` seconds. Results
+        # of async adapters cost the time since the first of their calls.
+        def inner(tx):
+            nbytes = 0
+            pending = tx.get(cache_key.encode(), db=self.dbs["pending"])
+            since = json.loads(bytes(pending)) if pending is not None else time.time() - (cost or 0)
+            if resp == "":
+                tx.put(cache_key.encode(), json.dumps(since).encode(), db=self.dbs["pending"])
+            elif pending is not None:
+                tx.delete(cache_key.encode(), db=self.dbs["pending"])
+            if resp:
+                total = cost if pending is None else time.time() - since
+                nbytes = self._store(tx, cache_key.encode(), resp.encode(), fn, total)
+                self._auto_evict(tx)
+            if fn is not None:
+                self._count(tx, fn, errors=int(resp is None), wall_time=cost or 0, bytes=nbytes)
+            lease = tx.get(cache_key.encode(), db=self.dbs["leases"])
+            if lease is not None and json.loads(bytes(lease))["id"] == lease_id:
+                tx.delete(cache_key.encode(), db=self.dbs["leases"])
+
+        self._resize_call(inner, write=True)
+
+    def stats(self):
+        """
+        The call counters of each function (by adapter and uri) submitted to the cache.
+
+        Returns
+        -------
+        list of dict
+            With the function's "adapter" and "uri", its "hits", "misses"
+            (calls of the adapter), "polls" (later calls of async adapters
+            still running), "waits" (for a call with the same cache key in
+            flight), "errors" (failed adapter calls), "wait_time" and
+            "wall_time" (seconds spent waiting and in the adapter), "bytes"
+            (of results stored) and "hit_rate".
+        """
+
+        def inner(tx):
+            with tx.cursor(db=self.dbs["stats"]) as cursor:
+                return [(json.loads(bytes(k)), json.loads(bytes(v))) for k, v in cursor]
+
+        result = []
+        for (adapter, uri), stats in sorted(self._resize_call(inner), key=lambda x: [str(y) for y in x[0]]):
+            stats = {k: stats.get(k, 0) for k in STATS}  # counted before some of them existed
+            calls = stats["hits"] + stats["misses"]
+            result.append({"adapter": adapter, "uri": uri, **stats, "hit_rate": stats["hits"] / calls if calls else 0})
+        return result
+
+    def submit(self, fn, cache_key, dump):
+        """
+        Return the cached result of a function call, or else call its adapter.
+
+        Write transactions are only held briefly: to claim a lease on the cache
+        key ("in flight by pid@host until expiry"), and to store the result
+        and release the lease. The adapter runs in between without any lock,
+        so calls with different keys run concurrently, and adapters can use
+        the cache themselves. A call finding a live lease on its key polls
+        until the lease is released (or abandoned) instead of calling the
+        adapter again. Hits and new results are recorded for eviction (see
+        Eviction), with the time the adapter took as the result's cost (from
+        its first call, for async adapters returning nothing until they are
+        done), and each call's outcome is counted (see `stats`).
+        """
+        delay, waited, start = LEASE_POLL[0], None, time.time()
+        while True:
+            cached_val, lease_id = self._claim(cache_key, fn, waited)
+            if cached_val is not None:
+                return decompress_value(cached_val).decode()  # outside of the transaction
+            if lease_id is not None:
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, LEASE_POLL[1])
+            waited = time.time() - start
+        resp, start = None, time.time()
+        try:
             cmd = shutil.which(fn.adapter or "")
             assert cmd, f"no such adapter: {fn.adapter}"
             payload = json.dumps(
@@ -189,10 +919,32 @@ class Cache:
                 logger.error(proc.stderr.rstrip())
             assert proc.returncode == 0, f"{cmd}: exit status: {proc.returncode}\n{proc.stderr}"
             resp = proc.stdout
-            if resp:
-                try:
-                    tx.put(cache_key.encode(), resp.encode())
-                    return resp
-                except lmdb.MapFullError:
-                    self.put(cache_key, resp)
             return resp
+        finally:
+            self._release(cache_key, lease_id, resp, time.time() - start, fn)
+
+
+def summarize(val):
+    """Whether a cached dump (see Cache.describe) is an error, and the id of its dag (if it isn't)."""
+    try:
+        js = json.loads(val)
+        if js[0] == "Error":
+            return {"error": True, "dag_id": None}
+        return {"error": False, "dag_id": js[-1][1][1]}
+    except (ValueError, LookupError, TypeError):  # not a dump
+        return {"error": None, "dag_id": None}
+
+
+def lease_expired(lease):
+    """True if a cache lease (see Cache.submit) has expired or its process on this host is gone."""
+    if lease["expires"] < time.time():
+        return True
+    if lease["host"] != socket.gethostname():
+        return False
+    try:
+        os.kill(lease["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
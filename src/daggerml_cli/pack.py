@@ -10,6 +10,15 @@ NXT_CODE = 0
 EXT_CODE = {}
 EXT_TYPE = {}
 EXT_PACK = {}
+EXT_SAME_HASH = set()  # codes whose hash encoding is identical to their data encoding
+TYPE_CODE = {}
+
+
+def ext_code(obj):
+    cls = type(obj)
+    if cls not in TYPE_CODE:
+        TYPE_CODE[cls] = EXT_CODE.get(fullname(cls))
+    return TYPE_CODE[cls]
 
 
 def next_code():
@@ -18,25 +27,53 @@ def next_code():
     return NXT_CODE
 
 
-def register(cls, pack, unpack):
+def register(cls, pack, unpack, same_hash=True):
     code = next_code()
     name = fullname(cls)
     EXT_TYPE[code] = cls
     EXT_CODE[name] = code
     EXT_PACK[code] = [pack, unpack]
+    TYPE_CODE.clear()
+    if same_hash:
+        EXT_SAME_HASH.add(code)
+
 
+def packb(x, hash=False, memo=None) -> bytes:
+    # Objects nested in other objects are always packed in full, regardless of
+    # `hash`. Encodings of hashable objects (eg. Refs) are memoized for the
+    # duration of the call.
+    memo = {} if memo is None else memo
 
-def packb(x, hash=False) -> bytes:
     def default(obj):
-        code = EXT_CODE.get(fullname(obj))
+        code = ext_code(obj)
         if code:
+            key = (code, hash, obj) if type(obj).__hash__ is not None else None
+            if key is not None and key in memo:
+                return memo[key]
             data = EXT_PACK[code][0](obj, hash)
-            return ExtType(code, packb(sort_dict_recursively(data)))
+            result = ExtType(code, packb(sort_dict_recursively(data), memo=memo))
+            if key is not None:
+                memo[key] = result
+            return result
         raise TypeError(f"unknown type: {type(obj)}")
 
     return asserting(msgpack.packb(x, default=default))
 
 
+def packb_hash(x):
+    """
+    Pack `x` for storage and for hashing in one pass.
+
+    Returns
+    -------
+    A (data, hash data) tuple of bytes. These are the same object unless the
+    type of `x` excludes fields from its hash.
+    """
+    data = packb(x)
+    code = ext_code(x)
+    return data, (data if code in EXT_SAME_HASH else packb(x, True))
+
+
 def unpackb(x):
     def ext_hook(code, data):
         cls = EXT_TYPE.get(code)
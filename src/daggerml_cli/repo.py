@@ -1,23 +1,43 @@
 import json
 import logging
 import os
+import threading
 import traceback as tb
-from collections import Counter
-from contextlib import contextmanager
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping, MutableSet
+from contextlib import ExitStack, contextmanager, nullcontext
+from copy import copy
 from dataclasses import InitVar, dataclass, field, fields, is_dataclass
-from hashlib import md5
+from functools import lru_cache
+from hashlib import blake2b, md5
+from heapq import heapify, heappop, heappush
 from typing import TYPE_CHECKING, Any, Dict, Optional, Type, Union, cast
 from urllib.parse import urlparse
 from uuid import uuid4
 
-from daggerml_cli.db import Cache, dbenv, get_map_size
-from daggerml_cli.pack import packb, register, unpackb
+import lmdb
+
+from daggerml_cli.db import Cache, MapGrowth, Resizer, dbenv, durability_flags, get_map_size, storage_backend
+from daggerml_cli.pack import packb, packb_hash, register, unpackb
 from daggerml_cli.util import asserting, assoc, conj, makedirs, now
 
+try:
+    import xxhash
+except ImportError:  # optional dependency
+    xxhash = None
+
 if TYPE_CHECKING:
     from daggerml_cli.config import Config
 DEFAULT_BRANCH = "head/main"
+DEFAULT_HASH_ALGO = "md5"
 DATA_TYPE = {}
+GC_ROOTS = ["head", "index", "deleted"]  # objects of these types are never collected
+BLOB_TYPES = ["datum"]  # kept in an environment of their own by split repos (see Repo.split)
+# bookkeeping databases, not object stores
+META_DBS = ["refcount", "gcqueue", "children", "generation", "staging", "ephemeral", "blobs"]
+OBJECT_CACHE_SIZE = 4096  # decoded objects kept per transaction (see Repo.get)
+KNOWN_KEYS_SIZE = 1 << 16  # stored keys remembered per transaction (see Repo.put)
 NONE = uuid4()
 REPO_TYPES = []
 
@@ -34,6 +54,14 @@ BUILTIN_FNS = {
     "conj": conj,
 }
 
+# All ids are 128 bit hex digests, whichever the algorithm.
+HASH_ALGOS = {
+    "md5": lambda x: md5(x).hexdigest(),
+    "blake2b": lambda x: blake2b(x, digest_size=16).hexdigest(),
+}
+if xxhash is not None:
+    HASH_ALGOS["xxh128"] = xxhash.xxh128_hexdigest
+
 logger = logging.getLogger(__name__)
 register(set, lambda x, _: sorted(list(x), key=packb), lambda x: [tuple(x)])
 
@@ -99,6 +127,64 @@ def unroll_datum(value):
     return get(value)
 
 
+@lru_cache(maxsize=None)
+def field_names(cls):
+    return [x.name for x in fields(cls)]
+
+
+def iter_refs(x):
+    """Yield each Ref nested in `x` (without dereferencing them)."""
+    xs = [x]
+    while len(xs):
+        x = xs.pop()
+        if isinstance(x, Ref):
+            yield x
+        elif isinstance(x, (list, set, tuple)):
+            xs.extend(x)
+        elif isinstance(x, dict):
+            xs.extend(x.values())
+        elif isinstance(x, Executable):
+            xs.extend(x.data.values())
+            xs.extend(x.prepop.values())
+        elif isinstance(x, (Error, Resource)):
+            pass  # cannot recurse into these classes
+        elif is_dataclass(x):
+            xs.extend(getattr(x, y) for y in field_names(type(x)))
+
+
+def thaw(obj):
+    """
+    Copy `obj` so that the copy can be mutated the way repo objects are (ie.
+    by setting fields and updating the collections in them) without touching
+    the original.
+    """
+    if isinstance(obj, (list, dict, set)):
+        return copy(obj)
+    if not is_dataclass(obj) or isinstance(obj, (Ref, Error)):
+        return obj
+    result = copy(obj)
+    for k in field_names(type(obj)):
+        v = getattr(obj, k)
+        if isinstance(v, (list, dict, set)) or (is_dataclass(v) and not isinstance(v, (Ref, Error))):
+            setattr(result, k, copy(v))
+    return result
+
+
+def map_refs(fn, x):
+    """Replace each Ref `r` nested in `x` with `fn(r)`."""
+    if isinstance(x, Ref):
+        return fn(x)
+    if isinstance(x, list):
+        return [map_refs(fn, y) for y in x]
+    if isinstance(x, set):
+        return {map_refs(fn, y) for y in x}
+    if isinstance(x, dict):
+        return {k: map_refs(fn, v) for k, v in x.items()}
+    if is_dataclass(x) and not isinstance(x, type):
+        return type(x)(*[map_refs(fn, getattr(x, y.name)) for y in fields(x)])
+    return x
+
+
 def raise_ex(x):
     if isinstance(x, Exception):
         raise x
@@ -139,7 +225,7 @@ def repo_type(cls=None, **kwargs):
 
     def decorator(cls):
         DATA_TYPE[cls.__name__] = cls
-        register(cls, packfn, lambda x: x)
+        register(cls, packfn, lambda x: x, same_hash=tohash is None and not nohash)
         if dbtype:
             REPO_TYPES.append(cls.__name__.lower())
         return cls
@@ -161,7 +247,7 @@ class Ref:
         return self.to.split("/", 1)[1] if self.to else None
 
     def __call__(self):
-        return Repo.curr.get(self)
+        return Repo.current().get(self)
 
 
 @dataclass(frozen=True, order=True)
@@ -266,14 +352,14 @@ class Commit:
 @repo_type
 @dataclass
 class Tree:
-    dags: dict[str, Ref]  # -> dag
+    dags: Union[dict, "PMap"]  # -> dag
 
 
 @repo_type
 @dataclass
 class Dag:
-    nodes: list[Ref]  # -> node
-    names: Dict[str, Ref]  # -> node
+    nodes: Union[list, "PSet"]  # -> node
+    names: Union[dict, "PMap"]  # -> node
     result: Optional[Ref]  # -> node
     error: Optional[Error]
 
@@ -354,6 +440,243 @@ class Datum:
     value: Union[None, str, bool, int, float, Resource, list, dict, set]
 
 
+# Persistent collections
+#
+# Large collections (eg. the nodes of a DAG) are stored as a hash array mapped
+# trie of content-addressed Shards so that updating one entry writes a new
+# path of shards instead of re-serializing the whole collection. The shape of
+# the trie depends only on its contents: a shard is a leaf when it holds at
+# most SHARD_SIZE entries and otherwise branches on the next hex digit of the
+# entries' key hashes. So equal collections have equal root refs.
+
+SHARD_SIZE = 32  # the most entries in a leaf shard
+SHARD_WIDTH = 16  # the children of a branch shard, one per hex digit
+
+
+def shard_hash(key):
+    # Fixed, rather than the repo's hash algo, so that a key's position in the
+    # trie does not depend on repo settings.
+    return md5((key.to if isinstance(key, Ref) else key).encode()).hexdigest()
+
+
+def cache_hash(dump):
+    # The cache key of a function call's dump. Fixed too: caches are shared by
+    # repos with different hash algos, and the FnDag an adapter's repo loads
+    # the dump into must get the caller's key.
+    return md5(dump.encode()).hexdigest()
+
+
+@repo_type
+@dataclass
+class Shard:
+    size: int  # number of entries in this subtree
+    keys: list  # leaf entries, sorted (empty in branches)
+    values: Optional[list] = None  # leaf values, aligned with keys (None in sets)
+    children: list = field(default_factory=list)  # -> shard | None, per hex digit (empty in leaves)
+
+    def entries(self):
+        return list(zip(self.keys, self.keys if self.values is None else self.values))
+
+
+def shard_put(entries, is_map, depth=0):
+    """Put the shard holding `entries`, a key sorted list of (key, value) pairs."""
+    if not len(entries):
+        return None
+    repo = Repo.current()
+    if len(entries) <= SHARD_SIZE or depth >= 32:
+        keys = [k for k, _ in entries]
+        return repo(Shard(len(entries), keys, [v for _, v in entries] if is_map else None))
+    buckets = [[] for _ in range(SHARD_WIDTH)]
+    for k, v in entries:
+        buckets[int(shard_hash(k)[depth], 16)].append((k, v))
+    return repo(Shard(len(entries), [], None, [shard_put(x, is_map, depth + 1) for x in buckets]))
+
+
+def shard_items(ref):
+    """Yield the (key, value) pairs in the trie rooted at `ref` (in no particular order)."""
+    xs = [ref]
+    while len(xs):
+        x = xs.pop()
+        if x is not None:
+            shard = x()
+            xs.extend(shard.children)
+            yield from shard.entries()
+
+
+def shard_get(ref, key):
+    """Returns a (found, value) pair."""
+    h = shard_hash(key)
+    depth = 0
+    while ref is not None:
+        shard = ref()
+        if not len(shard.children):
+            i = bisect_left(shard.keys, key)
+            if i < len(shard.keys) and shard.keys[i] == key:
+                return True, shard.entries()[i][1]
+            break
+        ref = shard.children[int(h[depth], 16)]
+        depth += 1
+    return False, None
+
+
+def shard_assoc(ref, key, value, is_map, depth=0):
+    """Returns the new root and whether an entry was added."""
+    shard = ref() if ref else Shard(0, [])
+    if not len(shard.children):
+        entries = shard.entries()
+        i = bisect_left(shard.keys, key)
+        if i < len(entries) and entries[i][0] == key:
+            if entries[i][1] == value:
+                return ref, False
+            entries[i] = (key, value)
+            return shard_put(entries, is_map, depth), False
+        entries.insert(i, (key, value))
+        return shard_put(entries, is_map, depth), True
+    i = int(shard_hash(key)[depth], 16)
+    child, added = shard_assoc(shard.children[i], key, value, is_map, depth + 1)
+    if child == shard.children[i]:
+        return ref, False
+    children = [child if j == i else x for j, x in enumerate(shard.children)]
+    return Repo.current()(Shard(shard.size + added, [], None, children)), added
+
+
+def shard_dissoc(ref, key, is_map, depth=0):
+    """Returns the new root and whether an entry was removed."""
+    if ref is None:
+        return ref, False
+    shard = ref()
+    if not len(shard.children):
+        i = bisect_left(shard.keys, key)
+        if i == len(shard.keys) or shard.keys[i] != key:
+            return ref, False
+        entries = shard.entries()
+        return shard_put(entries[:i] + entries[i + 1 :], is_map, depth), True
+    i = int(shard_hash(key)[depth], 16)
+    child, removed = shard_dissoc(shard.children[i], key, is_map, depth + 1)
+    if not removed:
+        return ref, False
+    children = [child if j == i else x for j, x in enumerate(shard.children)]
+    if shard.size - 1 <= SHARD_SIZE:  # collapse into a leaf
+        entries = sorted((x for y in children for x in shard_items(y)), key=lambda x: x[0])
+        return shard_put(entries, is_map, depth), True
+    return Repo.current()(Shard(shard.size - 1, [], None, children)), True
+
+
+def shard_diff(a, b):
+    """Yield (key, a value, b value) for the entries which differ, with NONE for missing entries."""
+    if a == b:
+        return
+    sa, sb = (x() if x else None for x in [a, b])
+    if sa and sb and len(sa.children) and len(sb.children):
+        for x, y in zip(sa.children, sb.children):
+            yield from shard_diff(x, y)
+        return
+    da, db = (dict(shard_items(x)) for x in [a, b])
+    for k in sorted(set(da).union(db)):
+        va, vb = da.get(k, NONE), db.get(k, NONE)
+        if va != vb:
+            yield k, va, vb
+
+
+@repo_type(db=False)
+@dataclass
+class PSet(MutableSet):
+    root: Optional[Ref] = None  # -> shard
+    size: int = 0
+
+    @classmethod
+    def of(cls, xs):
+        xs = sorted(set(xs))
+        return cls(shard_put([(x, x) for x in xs], False), len(xs))
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, x):
+        return shard_get(self.root, x)[0]
+
+    def __iter__(self):
+        return iter(sorted(k for k, _ in shard_items(self.root)))
+
+    def __len__(self):
+        return self.size
+
+    def add(self, x):
+        self.root, added = shard_assoc(self.root, x, x, False)
+        self.size += added
+
+    def discard(self, x):
+        self.root, removed = shard_dissoc(self.root, x, False)
+        self.size -= removed
+
+
+@repo_type(db=False)
+@dataclass
+class PMap(MutableMapping):
+    root: Optional[Ref] = None  # -> shard
+    size: int = 0
+
+    @classmethod
+    def of(cls, kvs):
+        kvs = sorted(dict(kvs).items(), key=lambda x: x[0])
+        return cls(shard_put(kvs, True), len(kvs))
+
+    def __getitem__(self, k):
+        found, v = shard_get(self.root, k)
+        if not found:
+            raise KeyError(k)
+        return v
+
+    def __setitem__(self, k, v):
+        self.root, added = shard_assoc(self.root, k, v, True)
+        self.size += added
+
+    def __delitem__(self, k):
+        self.root, removed = shard_dissoc(self.root, k, True)
+        if not removed:
+            raise KeyError(k)
+        self.size -= 1
+
+    def __iter__(self):
+        return iter(sorted(k for k, _ in shard_items(self.root)))
+
+    def __len__(self):
+        return self.size
+
+    def items(self):
+        return sorted(shard_items(self.root), key=lambda x: x[0])
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def diff(self, other):
+        """Yield (key, value, other value) for the entries which differ, with NONE for missing entries."""
+        yield from shard_diff(self.root, other.root)
+
+
+def persistent_collections(obj):
+    """Replace the plain list/dict collections of a Dag or Tree with persistent ones, in place."""
+    if isinstance(obj, Dag):
+        if not isinstance(obj.nodes, PSet):
+            obj.nodes = PSet.of(obj.nodes)
+        if not isinstance(obj.names, PMap):
+            obj.names = PMap.of(obj.names)
+    elif isinstance(obj, Tree) and not isinstance(obj.dags, PMap):
+        obj.dags = PMap.of(obj.dags)
+    return obj
+
+
+def plain_collections(obj):
+    """Replace the persistent collections of a Dag or Tree with plain lists/dicts, in place."""
+    if isinstance(obj, Dag):
+        obj.nodes = sorted(obj.nodes)
+        obj.names = dict(obj.names)
+    elif isinstance(obj, Tree):
+        obj.dags = dict(obj.dags)
+    return obj
+
+
 @dataclass
 class Ctx:
     head: Union[Head, Index]
@@ -375,6 +698,20 @@ class Ctx:
         return cls(head, commit, tree, dags, dag)
 
 
+@dataclass
+class Staged:
+    """
+    Datums packed and hashed ahead of the write transaction that stores them
+    (see Repo.stage_datum).
+    """
+
+    ref: Ref
+    writes: list = field(default_factory=list)  # (key, data, known, obj) tuples, children first
+    refs: list = field(default_factory=list)  # existing refs, checked when the datums are stored
+    hash_algo: Optional[str] = None  # the algo the keys were hashed with
+    value: Any = None  # staged again if the repo's hash algo was migrated meanwhile
+
+
 @dataclass
 class Repo:
     path: str
@@ -382,17 +719,63 @@ class Repo:
     head: Ref = field(default_factory=lambda: Ref(DEFAULT_BRANCH))  # -> head
     create: InitVar[bool] = False
     cache_path: Optional[str] = None
-
-    def __post_init__(self, create):
+    hash_algo: InitVar[Optional[str]] = None  # only used when creating the repo
+    map_growth: Optional[MapGrowth] = None  # defaults to MapGrowth()
+    durability: Optional[str] = None  # defaults to strict (see db.DURABILITY)
+    staging: Optional[bool] = None  # defaults to off (see put_node)
+    storage: Optional[str] = None  # defaults to lmdb (see db.STORAGE)
+    split: Optional[bool] = None  # defaults to off for new repos, and to how existing ones were created
+    cache_options: Optional[dict] = None  # keyword arguments of the Cache opened for function calls
+    _local = threading.local()  # the repo whose transaction is active, per thread
+
+    def __post_init__(self, create, hash_algo):
         self._tx = []
+        self._objs = OrderedDict()
+        self._known = set()
+        self._parent = None  # see `joined`
+        self._btx = None  # the blob transaction of split repos (see `_txn`)
+        self._bwrite = False  # whether it is a write transaction
+        self._cache = None
         dbfile = str(os.path.join(self.path, "data.mdb"))
-        dbfile_exists = os.path.exists(dbfile)
+        dbfile_exists = storage_backend(self.storage)[1](self.path)
         if create:
             assert not dbfile_exists, f"repo already exists: {dbfile}"
         else:
             assert dbfile_exists, f"repo not found: {dbfile}"
-        self.env, self.dbs = dbenv(self.path, REPO_TYPES, map_size=get_map_size(self.path))
+        flags = durability_flags(self.durability)
+        assert not (create and flags.get("readonly")), "cannot create a read only repo"
+        # Split repos keep BLOB_TYPES in a second environment (in the "blobs"
+        # subdirectory), so that big blob writes don't stall metadata writes
+        # nor grow their map. Repo.tx coordinates the two, and the "blobs"
+        # meta db marks the blobs whose refs are counted (see `_write_blob`).
+        blob_path = os.path.join(self.path, "blobs")
+        if create:
+            self.split = bool(self.split)
+        else:
+            self.split = storage_backend(self.storage)[1](blob_path)
+        types = [x for x in REPO_TYPES if not (self.split and x in BLOB_TYPES)]
+        self.env, dbs = dbenv(self.path, types + META_DBS, self.storage, map_size=get_map_size(self.path), **flags)
+        self.blob_env = None
+        if self.split:
+            makedirs(blob_path)
+            self.blob_env, blob_dbs = dbenv(
+                blob_path, BLOB_TYPES, self.storage, map_size=get_map_size(blob_path), **flags
+            )
+            dbs = {**dbs, **blob_dbs}
+        # read only envs skip the databases which don't exist (yet), so reads of them find nothing
+        self.dbs = {k: dbs[k] for k in REPO_TYPES if k in dbs}
+        self.meta = {k: dbs.get(k) for k in META_DBS}
+        self.map_growth = self.map_growth or MapGrowth()
+        self.staging = bool(self.staging)
+        self._resizer = Resizer(self.env, self.map_growth)
+        self._blob_resizer = Resizer(self.blob_env, self.map_growth) if self.split else None
         with self.tx(bool(create)):
+            if create:
+                self("/hash", hash_algo or DEFAULT_HASH_ALGO)
+                self("/refcount", "1")  # older repos build refcounts on their first gc
+                self("/children", "1")  # ditto the commit children index
+                self("/generation", "1")  # and commit generation numbers
+            self._use_hash_algo(self.get("/hash") or "md5")  # repos predating /hash use md5
             if not self.get("/init"):
                 commit = Commit(
                     [],
@@ -415,10 +798,49 @@ class Repo:
         user = config.USER or "unknown"
         cache_path = config.CACHE_PATH or None
         head = config.BRANCHREF or Ref(DEFAULT_BRANCH)
-        return cls(repo_path, user=user, head=head, create=create, cache_path=cache_path)
+        return cls(repo_path, user=user, head=head, create=create, cache_path=cache_path, **config.REPO_OPTIONS)
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, "repo", None)
+
+    def session(self, *, user=None, head=None, cache_path=None, cache=None, staging=None):
+        """
+        Create a Repo that shares this repo's open environment.
+
+        The session has its own transaction stack, so sessions can be used
+        concurrently from different threads (eg. by `dml serve`). Closing the
+        environment is left to the original repo.
+
+        Parameters
+        ----------
+        user: user name (defaults to this repo's user)
+        head: branch ref to check out (defaults to this repo's head)
+        cache_path: cache path (defaults to this repo's cache path)
+        cache: an open Cache to use for function calls instead of opening one
+        staging: whether to stage nodes put to open indexes (defaults to this repo's setting)
+
+        Returns
+        -------
+        Repo
+        """
+        result = copy(self)
+        result._tx = []
+        result._objs, result._known = OrderedDict(), set()
+        result._parent = result._btx = None
+        result._bwrite = False
+        result._cache = cache
+        result.user = user or self.user
+        result.cache_path = cache_path or self.cache_path
+        result.staging = self.staging if staging is None else staging
+        with result.tx():
+            result.checkout(head or self.head)
+        return result
 
     def close(self):
         self.env.close()
+        if self.blob_env is not None:
+            self.blob_env.close()
 
     def __enter__(self):
         return self
@@ -430,106 +852,466 @@ class Repo:
         return self.put(key, obj, return_existing=return_existing)
 
     def db(self, type):
-        return self.dbs[type] if type else None
+        return self.dbs.get(type) if type else None
+
+    def _txn(self, type, write=False):
+        # The LMDB transaction for objects of a type (see `split`). The blob
+        # transaction starts out read only, and only takes the write lock of
+        # the blob environment once a blob is written (or deleted).
+        if self._btx is None or type not in BLOB_TYPES:
+            return self._tx[0]
+        if write and not self._bwrite:
+            self._btx.abort()
+            self._btx = self.blob_env.begin(write=True, buffers=True).__enter__()
+            self._bwrite = True
+        return self._btx
 
     @contextmanager
-    def tx(self, write=False):
-        cls = type(self)
-        old_curr = getattr(cls, "curr", None)
-        try:
-            if not len(self._tx):
-                self._tx.append(self.env.begin(write=write, buffers=True).__enter__())
-                cls.curr = self
+    def tx(self, write=False, *, atomic=False):
+        # Transactions are committed even when an exception escapes them (eg.
+        # a failed fn node is still recorded) unless `atomic` is set, in which
+        # case the outermost transaction is aborted instead. A transaction that
+        # ran out of map space (or found it grown by another process) is always
+        # aborted (see `transact`).
+        local = type(self)._local
+        old_curr = getattr(local, "repo", None)
+        exc = None
+        with ExitStack() as stack:
+            if not len(self._tx) and self._parent is not None:
+                if self.split:
+                    self._btx, self._bwrite = self.blob_env.begin(buffers=True).__enter__(), False
+                self._tx.append(self.env.begin(write=True, parent=self._parent, buffers=True).__enter__())
+                self._objs, self._known = OrderedDict(), set()
+                local.repo = self
+                self._use_hash_algo(self.get("/hash") or "md5")  # it may have been migrated meanwhile
+            elif not len(self._tx):
+                active, self._btx, tx = self._begin(write)
+                stack.enter_context(active)
+                self._bwrite = False
+                self._tx.append(tx)
+                self._objs, self._known = OrderedDict(), set()
+                local.repo = self
+                self._use_hash_algo(self.get("/hash") or "md5")  # it may have been migrated meanwhile
             else:
                 self._tx.append(None)
-            yield True
+            try:
+                yield True
+            except BaseException as e:
+                exc = e if atomic or isinstance(e, (lmdb.MapFullError, lmdb.MapResizedError)) else None
+                raise
+            finally:
+                local.repo = old_curr
+                tx = self._tx.pop()
+                if tx:
+                    self._objs, self._known = OrderedDict(), set()
+                    args = (type(exc), exc, exc.__traceback__) if exc else (None, None, None)
+                    btx, self._btx, self._bwrite = self._btx, None, False
+                    try:
+                        if btx is not None:  # blobs first, so that metadata never refers to missing ones
+                            btx.__exit__(*args)
+                    except BaseException:
+                        tx.abort()
+                        raise
+                    tx.__exit__(*args)
+
+    def _begin(self, write):
+        # Begins the outermost transactions, registered with the resizers (see
+        # `tx`). If another process (eg. `dml load` next to `dml serve`) grew a
+        # map meanwhile, LMDB refuses to begin until its new size is adopted.
+        resizers = [self._resizer, self._blob_resizer] if self.split else [self._resizer]
+        while True:
+            with ExitStack() as active:
+                for resizer in resizers:
+                    if write:
+                        resizer.grow()
+                    active.enter_context(resizer.active())
+                btx = None
+                try:
+                    btx = self.blob_env.begin(buffers=True) if self.split else None
+                    return active.pop_all(), btx, self.env.begin(write=write, buffers=True)
+                except lmdb.MapResizedError:
+                    if btx is not None:
+                        btx.abort()
+            for resizer in resizers:
+                resizer.adopt()
+
+    def transact(self, fn, *args, **kwargs):
+        """
+        Call `fn(*args, **kwargs)`, replaying it if it runs out of map space.
+
+        When a write transaction opened by `fn` fills the LMDB map, it is
+        aborted, the map is grown (see MapGrowth) and `fn` is called again, so
+        `fn` must be safe to re-run. Likewise when the blob environment of a
+        split repo was grown by another process before `fn` wrote to it. Only
+        the outermost call replays: within a transaction `fn` is just called.
+        """
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except (lmdb.MapFullError, lmdb.MapResizedError) as e:
+                if len(self._tx) or self._parent is not None:
+                    raise
+                # no telling which environment of a split repo it was
+                for resizer in [self._resizer, self._blob_resizer] if self.split else [self._resizer]:
+                    if isinstance(e, lmdb.MapResizedError):
+                        resizer.adopt()
+                    else:
+                        resizer.grow(force=True)
+
+    @contextmanager
+    def joined(self, parent):
+        """
+        Run this repo's transactions as nested transactions of `parent`, a
+        write transaction opened by another Repo on the same environment in
+        this thread (see server.GroupCommit).
+
+        Each outermost transaction commits into (or is aborted without
+        affecting) `parent`, which is committed by its owner. Running out of
+        map space is left to the owner too, so `transact` doesn't replay.
+        The blobs of split repos are committed by each outermost transaction.
+        """
+        assert not len(self._tx), "cannot join a transaction from within a transaction"
+        self._parent = parent
+        try:
+            yield self
         finally:
-            cls.curr = old_curr
-            tx = self._tx.pop()
-            if tx:
-                tx.__exit__(None, None, None)
+            self._parent = None
 
     def copy(self, path):
         self.env.copy(makedirs(path))
+        if self.split:
+            self.blob_env.copy(makedirs(os.path.join(path, "blobs")))
+
+    def _use_hash_algo(self, algo):
+        assert algo in HASH_ALGOS, f"unsupported hash algorithm: {algo}"
+        self.hash_algo = algo
+        self.digest = HASH_ALGOS[algo]
 
     def hash(self, obj):
-        return md5(packb(obj, True)).hexdigest()
+        return self.digest(packb(obj, True))
 
     def get(self, key):
+        # Decoded objects are cached for the rest of the transaction (the
+        # cache is invalidated by put and delete). Callers get a thawed copy
+        # so they are free to modify it.
         assert isinstance(key, (Ref, str)), f"unexpected key type: {type(key)}"
-        key = key if isinstance(key, Ref) else Ref(key)
-        obj = unpackb(self._tx[0].get(key.to.encode(), db=self.db(key.type)))
-        return obj
+        key = key.to if isinstance(key, Ref) else key
+        if key in self._objs:
+            self._objs.move_to_end(key)
+            return thaw(self._objs[key])
+        obj = unpackb(self._txn(Ref(key).type).get(key.encode(), db=self.db(Ref(key).type)))
+        self._objs[key] = obj
+        if len(self._objs) > OBJECT_CACHE_SIZE:
+            self._objs.popitem(last=False)
+        return thaw(obj)
 
     def put(self, key, obj=None, *, return_existing=False) -> Ref:
         key, obj = (key, obj) if obj else (obj, key)
         assert obj is not None
         key = key if isinstance(key, Ref) else Ref(key)
-        db = key.type if key.to else type(obj).__name__.lower()
-        data = packb(obj)
-        key2 = key.to or f"{db}/{self.hash(obj)}"
-        comp = None
         if key.to is None:
-            comp = self._tx[0].get(key2.encode(), db=self.db(db))
-            if comp not in [None, data]:
-                if return_existing:
-                    return Ref(key2)
-                msg = f"attempt to update immutable object: {key2}"
-                raise AssertionError(msg)
-        if key is None or comp is None:
-            self._tx[0].put(key2.encode(), data, db=self.db(db))
-        return Ref(key2)
+            return self._put_packed(*self.pack(obj), obj, return_existing=return_existing)
+        data, db = packb(obj), key.type
+        old = self._txn(db).get(key.to.encode(), db=self.db(db)) if db in self.dbs and self._refcounting() else None
+        self._write(key.to, data, old, obj)
+        return Ref(key.to)
+
+    def pack(self, obj):
+        """
+        Encode and hash a content-addressed object.
+
+        Only Dags and Trees (whose collections are stored as shards) need a
+        transaction for this, so other objects can be packed before the write
+        transaction that stores them (see `stage_datum`).
+
+        Returns
+        -------
+        A (key, data, known) tuple: the object's key, its packed bytes and
+        whether the key alone determines the bytes (ie. all fields are hashed).
+        """
+        data, hdata = packb_hash(persistent_collections(obj))
+        return f"{type(obj).__name__.lower()}/{self.digest(hdata)}", data, hdata is data
+
+    def _put_packed(self, key, data, known, obj, *, return_existing=False):
+        # Keys which determine their data and were already stored in this
+        # transaction need no lookup or rewrite.
+        if known and key in self._known:
+            return Ref(key)
+        old = self._txn(Ref(key).type).get(key.encode(), db=self.db(Ref(key).type))
+        if old not in [None, data]:
+            if return_existing:
+                return Ref(key)
+            msg = f"attempt to update immutable object: {key}"
+            raise AssertionError(msg)
+        self._write(key, data, old, obj)
+        if known:
+            if len(self._known) >= KNOWN_KEYS_SIZE:
+                self._known.clear()
+            self._known.add(key)
+        return Ref(key)
+
+    def _write(self, key, data, old, obj):
+        if self._btx is not None and Ref(key).type in BLOB_TYPES:
+            return self._write_blob(key, data, old, obj)
+        if old is None or old != data:
+            old = None if old is None else unpackb(old)  # before the buffer is invalidated by the write
+            self._objs.pop(key, None)
+            self._txn(Ref(key).type, write=True).put(key.encode(), data, db=self.db(Ref(key).type))
+            self._update_refcounts(Ref(key), old, obj)
+            self._update_commit_graph(Ref(key), old, obj)
+
+    def _write_blob(self, key, data, old, obj):
+        # The blob may already have been stored by an earlier blob transaction
+        # (see `write_staged`), so whether its refs are counted is tracked by
+        # a marker in the metadata environment rather than by its presence.
+        old = None if old is None else bytes(old)  # before the buffer is invalidated by the write
+        counted = not self._refcounting() or self._tx[0].get(key.encode(), db=self.meta["blobs"]) is not None
+        if not counted:
+            self._tx[0].put(key.encode(), b"", db=self.meta["blobs"])
+        if old != data:
+            self._objs.pop(key, None)
+            self._txn(Ref(key).type, write=True).put(key.encode(), data, db=self.db(Ref(key).type))
+        if not counted or old != data:
+            old = None if old is None or not counted else unpackb(old)
+            self._update_refcounts(Ref(key), old, obj)
+            self._update_commit_graph(Ref(key), old, obj)
+
+    def write_staged(self, staged):
+        """
+        Store the blobs of a Staged (see `stage_datum`) in a short blob
+        transaction of its own, so that the metadata transaction which then
+        puts it (see `put_staged`) doesn't hold the blob write lock meanwhile.
+
+        Only split repos outside of a transaction need this; otherwise it does
+        nothing.
+        """
+        if not self.split or len(self._tx) or not len(staged.writes):
+            return
+        if self._parent is None:  # else the owner of the parent is registered (see `joined`)
+            self._blob_resizer.grow()
+        with self._blob_resizer.active(), self.blob_env.begin(write=True) as tx:
+            for key, data, _, _ in staged.writes:
+                db = self.db(Ref(key).type)
+                if tx.get(key.encode(), db=db) is None:
+                    tx.put(key.encode(), data, db=db)
 
     def delete(self, key):
         key = Ref(key) if isinstance(key, str) else key
-        self._tx[0].delete(key.to.encode(), db=self.db(key.type))
+        old = self.get(key) if key.type in self.dbs else None
+        if key.type == "index":
+            self._unstage(key)
+        self._objs.pop(key.to, None)
+        self._known.discard(key.to)
+        if self._btx is not None and key.type in BLOB_TYPES:
+            if not self._tx[0].delete(key.to.encode(), db=self.meta["blobs"]):
+                old = None  # its refs were never counted
+        self._txn(key.type, write=True).delete(key.to.encode(), db=self.db(key.type))
+        if old is not None:
+            self._update_refcounts(key, old, None)
+            self._update_commit_graph(key, old, None)
+        if key.type == "index":
+            self._reclaim(key)
+
+    def _refcounting(self):
+        return self._tx[0].get(b"/refcount") is not None
+
+    def refcount(self, ref):
+        """The number of stored objects which refer to `ref`."""
+        count = self._tx[0].get(ref.to.encode(), db=self.meta["refcount"])
+        return 0 if count is None else int(bytes(count))
+
+    def _set_refcount(self, ref, count):
+        if count > 0:
+            self._tx[0].put(ref.to.encode(), str(count).encode(), db=self.meta["refcount"])
+        else:
+            self._tx[0].delete(ref.to.encode(), db=self.meta["refcount"])
+            self._tx[0].put(ref.to.encode(), b"", db=self.meta["gcqueue"])
+
+    def _update_refcounts(self, ref, old, new):
+        # Called whenever the object stored at `ref` changes from `old` to
+        # `new` (either may be None). Objects whose count drops to zero, and
+        # new objects, are queued for the collector to look at.
+        if ref.type not in self.dbs or not self._refcounting():
+            return
+        old_refs, new_refs = ({x for x in iter_refs(y) if x.to and x.type not in GC_ROOTS} for y in [old, new])
+        for x in new_refs - old_refs:
+            self._set_refcount(x, self.refcount(x) + 1)
+        for x in old_refs - new_refs:
+            self._set_refcount(x, self.refcount(x) - 1)
+        if old is None and ref.type not in GC_ROOTS:
+            self._tx[0].put(ref.to.encode(), b"", db=self.meta["gcqueue"])
+
+    def _update_commit_graph(self, ref, old, new):
+        # Maintains the parent -> child commit index and commit generation
+        # numbers. Index keys are "<parent>/<child>" so the children of a
+        # commit are a prefix scan.
+        for obj, update in [(old, self._tx[0].delete), (new, self._tx[0].put)]:
+            if isinstance(obj, Commit):
+                for x in obj.parents:
+                    if x and x.to:
+                        update(f"{x.to}/{ref.to}".encode(), b"", db=self.meta["children"])
+        if isinstance(old, Commit):
+            self._tx[0].delete(ref.to.encode(), db=self.meta["generation"])
+        if isinstance(new, Commit):
+            self._store_generation(ref, new)
+
+    def _store_generation(self, ref, commit):
+        # Stores the generation number of a new commit, unless an ancestor is
+        # missing: objects can be put in any order (eg. by load_ref), so it is
+        # deferred until then. Storing it completes the children waiting for it.
+        xs = [(ref, commit)]
+        while len(xs):
+            x, obj = xs.pop()
+            gens = [self.generation(y, strict=True) for y in obj.parents if y and y.to]
+            if None in gens:
+                continue
+            self._tx[0].put(x.to.encode(), str(1 + max(gens, default=0)).encode(), db=self.meta["generation"])
+            for y in self._child_index(x):
+                if self._tx[0].get(y.to.encode(), db=self.meta["generation"]) is None:
+                    child = self.get(y)
+                    if child is not None:
+                        xs.append((y, child))
+
+    def _rebuild_children(self):
+        self._tx[0].drop(self.meta["children"], delete=False)
+        for ref in self.cursor("commit"):
+            for x in self.get(ref).parents:
+                if x and x.to:
+                    self._tx[0].put(f"{x.to}/{ref.to}".encode(), b"", db=self.meta["children"])
+        self("/children", "1")
+
+    def _rebuild_generations(self):
+        memo = {}
+        for ref in self.cursor("commit"):
+            self.generation(ref, memo)
+        for ref, gen in memo.items():
+            if self.get(ref) is not None:
+                self._tx[0].put(ref.to.encode(), str(gen).encode(), db=self.meta["generation"])
+        self("/generation", "1")
+
+    def generation(self, commit, memo=None, strict=False):
+        """
+        The generation number of a commit: one more than the largest
+        generation of its parents (root commits are generation 1).
+
+        Generation numbers are stored as commits are put. Commits predating
+        them (until the next gc) have theirs computed from their ancestry,
+        using `memo` to share the work between calls.
+
+        Parameters
+        ----------
+        commit: Ref to a commit
+        memo: optional dict of already known generation numbers
+        strict: if True, missing commits make the result None instead of
+            being treated as roots
+
+        Returns
+        -------
+        int (or None)
+        """
+        memo = {} if memo is None else memo
+        xs = [commit]
+        while len(xs):
+            x = xs[-1]
+            if x in memo:
+                xs.pop()
+                continue
+            gen = self._tx[0].get(x.to.encode(), db=self.meta["generation"])
+            if gen is not None:
+                memo[x] = int(bytes(gen))
+                xs.pop()
+                continue
+            obj = self.get(x)
+            if obj is None and strict:
+                return None
+            parents = [y for y in obj.parents if y and y.to] if obj else []
+            todo = [y for y in parents if y not in memo]
+            if len(todo):
+                xs.extend(todo)
+                continue
+            memo[x] = 1 + max((memo[y] for y in parents), default=0)
+            xs.pop()
+        return memo[commit]
+
+    def _rebuild_refcounts(self):
+        counts = Counter()
+        for db in self.dbs:
+            for ref in self.cursor(db):
+                counts.update({x for x in iter_refs(self.get(ref)) if x.to and x.type not in GC_ROOTS})
+        for _, entries in self._staging_entries():
+            counts.update(x for x, _ in entries)
+        for db in META_DBS:
+            if db not in ["staging", "ephemeral"]:
+                self._tx[0].drop(self.meta[db], delete=False)
+        for ref, count in counts.items():
+            self._tx[0].put(ref.to.encode(), str(count).encode(), db=self.meta["refcount"])
+        for db in self.dbs:
+            if db not in GC_ROOTS:
+                for ref in self.cursor(db):
+                    if self.split and db in BLOB_TYPES:  # all of them are counted now
+                        self._tx[0].put(ref.to.encode(), b"", db=self.meta["blobs"])
+                    if not counts[ref]:
+                        self._tx[0].put(ref.to.encode(), b"", db=self.meta["gcqueue"])
+        self("/refcount", "1")
 
     def cursor(self, db):
+        if db not in self.dbs:  # eg. not created yet in a read only env
+            return iter([])
         return map(
             lambda x: Ref(bytes(x[0]).decode()),
-            iter(self._tx[0].cursor(db=self.db(db))),
+            iter(self._txn(db).cursor(db=self.db(db))),
         )
 
-    def walk(self, *key):
-        result = set()
-        xs = list(key)
-        while len(xs):
-            x = xs.pop(0)
-            if isinstance(x, Ref):
-                if x not in result:
-                    result.add(x)
-                    xs.append(self.get(x))
-            elif isinstance(x, (list, set)):
-                xs += [a for a in x if a not in result]
-            elif isinstance(x, dict):
-                xs += [a for a in x.values() if a not in result]
-            elif isinstance(x, (Error, Resource)):
-                pass  # cannot recurse into these classes
-            elif is_dataclass(x):
-                xs += [getattr(x, y.name) for y in fields(x)]
-        return result
+    def traverse(self, *key, prune=()):
+        """
+        Breadth first traversal of the objects reachable from `key`.
 
-    def walk_ordered(self, *key):
-        result = list()
-        xs = list(key)
+        Parameters
+        ----------
+        key: refs (or objects containing refs) to start from
+        prune: types of refs to skip -- they are neither decoded nor yielded,
+            so eg. a walk that only needs commits can prune "tree"
+
+        Yields
+        ------
+        Each reachable Ref, once, in the order it is first reached.
+        """
+        seen = set()
+        xs = deque(iter_refs(key))
         while len(xs):
-            x = xs.pop(0)
-            if isinstance(x, Ref):
-                if x not in result:
-                    result.append(x)
-                    xs.append(self.get(x))
-            elif isinstance(x, (list, set)):
-                xs += [a for a in x if a not in result]
-            elif isinstance(x, dict):
-                xs += [a for a in x.values() if a not in result]
-            elif isinstance(x, Executable):
-                xs += [a for a in x.data.values() if a not in result]
-                xs += [a for a in x.prepop.values() if a not in result]
-            elif isinstance(x, (Error, Resource)):
-                pass  # cannot recurse into these classes
-            elif is_dataclass(x):
-                xs += [getattr(x, y.name) for y in fields(x)]
-        return list(reversed(result))
+            x = xs.popleft()
+            if x not in seen and x.type not in prune:
+                seen.add(x)
+                yield x
+                xs.extend(iter_refs(self.get(x)))
+
+    def walk(self, *key, prune=()):
+        return set(self.traverse(*key, prune=prune))
+
+    def walk_ordered(self, *key, prune=()):
+        """
+        The refs reachable from `key` (see `traverse`) in dependency order:
+        each ref comes after every ref it refers to (a depth first post-order),
+        so loading them in order (see `load_ref`) never stores an object before
+        its references, and the root comes last.
+        """
+        entered, done = set(), {}  # done is an ordered set
+        for root in iter_refs(key):
+            if root in entered or root.type in prune:
+                continue
+            entered.add(root)
+            stack = [(root, iter_refs(self.get(root)))]
+            while len(stack):
+                x, children = stack[-1]
+                for y in children:
+                    if y not in entered and y.type not in prune:
+                        entered.add(y)
+                        stack.append((y, iter_refs(self.get(y))))
+                        break
+                else:
+                    stack.pop()
+                    done[x] = None
+        return list(done)
 
     def heads(self):
         return [k for k in self.cursor("head")]
@@ -551,7 +1333,7 @@ class Repo:
 
     def commits(self, ref=None):
         ref = self.head if ref is None else ref
-        return filter(lambda x: x.type == "commit", self.walk(ref))
+        return filter(lambda x: x.type == "commit", self.walk(ref, prune=["tree"]))
 
     def objects(self, type=None):
         result = set()
@@ -560,53 +1342,215 @@ class Repo:
         return result
 
     def reachable_objects(self):
-        result = set()
-        for db in ["head", "index", "deleted"]:
-            result = result.union(self.walk(*[k for k in self.cursor(db)]))
-        return result
+        return self.walk(*[k for db in ["head", "index", "deleted"] for k in self.cursor(db)])
 
     def unreachable_objects(self):
         return self.objects().difference(self.reachable_objects())
 
-    def gc(self):
+    def gc(self, limit=None):
+        """
+        Delete unreferenced objects.
+
+        Reference counts are maintained as objects are put and deleted, and
+        objects whose count drops to zero (or which were never referenced) are
+        queued. The collector only visits queued objects, so it does not need
+        to walk the repo, and it can be run in bounded slices.
+
+        Parameters
+        ----------
+        limit: the maximum number of queued objects to visit (default: all)
+
+        Returns
+        -------
+        Counters of deleted and remaining objects by type.
+        """
+        if not self._refcounting():
+            self._rebuild_refcounts()
+        if self.get("/children") is None:
+            self._rebuild_children()
+        if self.get("/generation") is None:
+            self._rebuild_generations()
+        deleted = []
+        visited = 0
+        while limit is None or visited < limit:
+            batch = []
+            with self._tx[0].cursor(db=self.meta["gcqueue"]) as cursor:
+                for k in cursor.iternext(values=False):
+                    if limit is not None and visited + len(batch) >= limit:
+                        break
+                    batch.append(Ref(bytes(k).decode()))
+            if not len(batch):
+                break
+            visited += len(batch)
+            deleted.extend(self._collect(batch))
+        remaining = {db: self._txn(db).stat(self.dbs[db])["entries"] for db in self.dbs if db != "deleted"}
+        return Counter(deleted), Counter({k: v for k, v in remaining.items() if v})
+
+    def _collect(self, refs, cascade=False):
+        # Deletes the unreferenced objects in `refs` (and, if `cascade`, the
+        # objects that become unreferenced as a result). Returns their types.
         deleted = []
-        for ref in self.unreachable_objects():
+        refs = list(refs)
+        while len(refs):
+            ref = refs.pop()
+            self._tx[0].delete(ref.to.encode(), db=self.meta["gcqueue"])
             obj = self.get(ref)
+            if obj is None or ref.type in GC_ROOTS or self.refcount(ref) > 0:
+                continue
             if isinstance(obj, Datum) and isinstance(obj.value, Resource) and not obj.value.uri.startswith("daggerml:"):
                 self(Deleted.resource(obj.value))
             self.delete(ref)
             deleted.append(ref.type)
-        remaining = [ref.type for ref in self.objects() if ref.type != "deleted"]
-        return Counter(deleted), Counter(remaining)
+            if cascade:
+                refs.extend(x for x in iter_refs(obj) if x.to and x.type in self.dbs and self.refcount(x) == 0)
+        return deleted
+
+    def migrate_hash(self, algo):
+        """
+        Re-address every object in the repo with a different hash algorithm.
+
+        Objects are rewritten dependencies first so that each new id is
+        computed from the new ids of the objects it refers to. Heads and
+        indexes are updated in place.
+
+        Parameters
+        ----------
+        algo: name of the new hash algorithm (see HASH_ALGOS)
+
+        Returns
+        -------
+        Counter of migrated objects by type.
+        """
+        assert algo in HASH_ALGOS, f"unsupported hash algorithm: {algo}"
+        named = ["head", "index"]
+        mapping = {}
+
+        def children(obj):
+            return [x for x in iter_refs(obj) if x.type not in named and x not in mapping]
+
+        def migrate(ref):
+            stack = [ref]
+            while len(stack):
+                x = stack[-1]
+                if x in mapping:
+                    stack.pop()
+                    continue
+                obj = plain_collections(self.get(x))  # shards are rebuilt, not migrated
+                deps = [] if obj is None else children(obj)
+                if len(deps):
+                    stack.extend(deps)
+                    continue
+                stack.pop()
+                if obj is None:  # dangling ref
+                    mapping[x] = x
+                    continue
+                obj = persistent_collections(map_refs(lambda y: mapping.get(y, y), obj))
+                mapping[x] = self.put(Ref(f"{x.type}/{self.digest(packb_hash(obj)[1])}"), obj)
+
+        if algo == self.hash_algo:
+            return Counter()
+        for index in self.indexes():
+            self.flush(index)
+        shards = list(self.cursor("shard"))
+        refs = [x for db in self.dbs if db not in [*named, "shard"] for x in self.cursor(db)]
+        self._use_hash_algo(algo)  # new shards are put with the new algo
+        for ref in refs:
+            migrate(ref)
+        for db in named:
+            for ref in list(self.cursor(db)):
+                self(ref, map_refs(lambda y: mapping.get(y, y), self.get(ref)))
+        for ref in refs + shards:
+            if mapping.get(ref) != ref:
+                self.delete(ref)
+        self("/hash", algo)
+        self.checkout(self.head)
+        return Counter(x.type for db in self.dbs if db not in named for x in self.cursor(db))
 
     def topo_sort(self, *xs):
-        xs = list(xs)
+        xs = list(reversed(xs))
+        seen = set()
         result = []
         while len(xs):
-            x = xs.pop(0)
-            if x is not None and self.get(x) and x not in result:
+            x = xs.pop()
+            if x is not None and x not in seen and self.get(x):
+                seen.add(x)
                 result.append(x)
-                xs = self.get(x).parents + xs
+                xs.extend(reversed(self.get(x).parents))
         return result
 
     def merge_base(self, a, b):
-        while True:
-            aa = self.topo_sort(a)
-            ab = self.topo_sort(b)
-            if set(aa).issubset(ab):
-                return a
-            if set(ab).issubset(aa):
-                return b
-            pivot = max(set(aa).difference(ab), key=aa.index)()
-            assert len(pivot.parents), "no merge base found"
-            if len(pivot.parents) == 1:
-                return pivot.parents[0]
-            a, b = pivot.parents
+        """
+        The best common ancestor of two commits.
+
+        Ancestors are visited in decreasing generation order, marking which
+        of `a` and `b` reach them. The first commit reached from both sides
+        is the common ancestor with the highest generation number, and the
+        walk stops there, so its cost depends on how far the two commits have
+        diverged rather than on the length of their history.
+
+        Parameters
+        ----------
+        a: Ref to a commit
+        b: Ref to a commit
+
+        Returns
+        -------
+        Ref to a commit
+        """
+        memo = {}
+        flags = {a: 1, b: 2} if a != b else {a: 3}
+        xs = [(-self.generation(x, memo), x) for x in flags]
+        heapify(xs)
+        done = set()
+        while len(xs):
+            _, x = heappop(xs)
+            if x in done:
+                continue
+            done.add(x)
+            if flags[x] == 3:
+                return x
+            obj = self.get(x)
+            for y in obj.parents if obj else []:
+                if y and y.to and flags.get(y, 0) | flags[x] != flags.get(y):
+                    flags[y] = flags.get(y, 0) | flags[x]
+                    heappush(xs, (-self.generation(y, memo), y))
+        raise AssertionError("no merge base found")
+
+    def is_ancestor(self, a, b):
+        """
+        Whether commit `a` is `b` or one of its ancestors, eg. whether `b`
+        can be fast-forwarded to from `a`.
+
+        Commits with a lower generation number than `a` cannot have `a` as an
+        ancestor, so the walk from `b` stops at `a`'s generation.
+        """
+        memo = {}
+        gen = self.generation(a, memo)
+        xs = [b]
+        seen = set()
+        while len(xs):
+            x = xs.pop()
+            if x == a:
+                return True
+            if x in seen or self.generation(x, memo) <= gen:
+                continue
+            seen.add(x)
+            obj = self.get(x)
+            xs.extend(y for y in (obj.parents if obj else []) if y and y.to)
+        return False
 
     def diff(self, t1, t2):
         d1 = self.get(t1).dags
         d2 = self.get(t2).dags
         result = {"add": {}, "rem": {}}
+        if isinstance(d1, PMap) and isinstance(d2, PMap):
+            # only visits the parts of the tries which differ
+            for k, v1, v2 in d1.diff(d2):
+                if v1 is not NONE:
+                    result["rem"][k] = v1
+                if v2 is not NONE:
+                    result["add"][k] = v2
+            return result
         for k in set(d1.keys()).union(d2.keys()):
             if k not in d2:
                 result["rem"][k] = d1[k]
@@ -631,13 +1575,11 @@ class Repo:
         def merge_trees(base, a, b):
             return self.patch(a, self.diff(base, a), self.diff(base, b))
 
-        c0 = self.merge_base(c1, c2)
-        if c1 == c2:
-            return c2
-        if c0 == c2:
+        if self.is_ancestor(c2, c1):
             return c1
-        if c0 == c1:
+        if self.is_ancestor(c1, c2):
             return c2
+        c0 = self.merge_base(c1, c2)
         return self(
             Commit(
                 [c1, c2],
@@ -695,10 +1637,38 @@ class Repo:
         return ref
 
     def get_child_commits(self, commit):
+        """
+        The commits which have `commit` as a parent.
+
+        Looked up in the children index, which is kept up to date as commits
+        are put and deleted. Repos predating the index (until their next gc)
+        fall back to scanning all commits. Commits which nothing refers to are
+        garbage awaiting collection and are left out.
+
+        Parameters
+        ----------
+        commit: Ref to a commit
+
+        Returns
+        -------
+        Set of commit Refs.
+        """
+        if self.get("/children") is None:
+            children = {x for x in self.cursor("commit") if commit in self.get(x).parents}
+        else:
+            children = self._child_index(commit)
+        return {x for x in children if self.refcount(x) > 0} if self._refcounting() else children
+
+    def _child_index(self, commit):
         children = set()
-        for x in self.reachable_objects():
-            if isinstance(self.get(x), Commit) and commit in self.get(x).parents:
-                children.add(commit)
+        prefix = f"{commit.to}/".encode()
+        with self._tx[0].cursor(db=self.meta["children"]) as cursor:
+            if cursor.set_range(prefix):
+                for k in cursor.iternext(values=False):
+                    k = bytes(k)
+                    if not k.startswith(prefix):
+                        break
+                    children.add(Ref(k[len(prefix) :].decode()))
         return children
 
     def create_branch(self, branch, ref):
@@ -722,26 +1692,59 @@ class Repo:
         self.head = ref
 
     def put_datum(self, value):
+        return self.put_staged(self.stage_datum(value))
+
+    def stage_datum(self, value):
+        """
+        Pack and hash `value` as a datum without touching the database.
+
+        The (possibly expensive) encoding can then happen before the write
+        transaction and `put_staged` only has to store the bytes.
+
+        Returns
+        -------
+        Staged
+        """
+        if not len(self._tx):
+            with self.tx():  # to read the hash algo, which may have been migrated
+                pass
+        staged = Staged(Ref(None), hash_algo=self.hash_algo, value=value)
+
         def put(value):
             if isinstance(value, Ref):
-                obj = self.get(value)
-                if isinstance(obj, Node):
-                    obj = self.get(obj.value)
-                assert isinstance(obj, Datum), f"not a datum: {value.to}"
+                staged.refs.append(value)
                 return value
             if isinstance(value, Datum):
-                return self(value)
-            if isinstance(value, (type(None), str, bool, int, float, Resource)):
-                return self(Datum(value))
-            if isinstance(value, list):
-                return self(Datum([put(x) for x in value]))
-            if isinstance(value, set):
-                return self(Datum({put(x) for x in value}))
-            if isinstance(value, dict):
-                return self(Datum({k: put(v) for k, v in value.items()}))
-            raise TypeError(f"repo put_datum unknown type: {type(value)}")
-
-        return put(value)
+                obj = value
+            elif isinstance(value, (type(None), str, bool, int, float, Resource)):
+                obj = Datum(value)
+            elif isinstance(value, list):
+                obj = Datum([put(x) for x in value])
+            elif isinstance(value, set):
+                obj = Datum({put(x) for x in value})
+            elif isinstance(value, dict):
+                obj = Datum({k: put(v) for k, v in value.items()})
+            else:
+                raise TypeError(f"repo put_datum unknown type: {type(value)}")
+            key, data, known = self.pack(obj)
+            staged.writes.append((key, data, known, obj))
+            return Ref(key)
+
+        staged.ref = put(value)
+        return staged
+
+    def put_staged(self, staged):
+        """Store the datums of a Staged (see `stage_datum`) and return its ref."""
+        if staged.hash_algo != self.hash_algo:
+            staged = self.stage_datum(staged.value)
+        for ref in staged.refs:
+            obj = self.get(ref)
+            if isinstance(obj, Node):
+                obj = self.get(obj.value)
+            assert isinstance(obj, Datum), f"not a datum: {ref.to}"
+        for key, data, known, obj in staged.writes:
+            self._put_packed(key, data, known, obj)
+        return staged.ref
 
     def get_dag(self, dag):
         return Ctx.from_head(self.head).dags.get(dag)
@@ -759,7 +1762,9 @@ class Repo:
         return True
 
     def dump_ref(self, ref, recursive=True):
-        return to_json([[x, self.get(x)] for x in self.walk_ordered(ref)] if recursive else [[ref.to, self.get(ref)]])
+        if not recursive:  # the persistent collections can't be read outside of the transaction
+            return to_json([[ref.to, plain_collections(self.get(ref))]])
+        return to_json([[x, self.get(x)] for x in self.walk_ordered(ref)])
 
     def load_ref(self, dump):
         dump = [self.put(k, v) for k, v in raise_ex(from_json(dump))]
@@ -788,25 +1793,119 @@ class Repo:
                     named_nodes,
                     None,
                     None,
-                    md5(dump.encode()).hexdigest(),
+                    cache_hash(dump),
                     argv,
                 )
             )
         commit = Commit([ctx.head.commit], self(ctx.tree), self.user, self.user, message, dag_name=name)
         index = self(Index(self(commit), dag))
+        self._track(index, [index().commit, dag])
         return index
 
     def put_node(self, data, index: Ref, name=None, doc=None):
-        ctx = Ctx.from_head(index)
-        node = data if isinstance(data, Ref) else self(Node(data, doc=doc))
-        if node not in ctx.dag.nodes:
-            ctx.dag.nodes = sorted([node, *ctx.dag.nodes], key=lambda x: x.to)
-        if name:
-            ctx.dag.names[name] = node
+        """
+        Add a node to the dag of an index (naming it `name`).
+
+        This writes a new dag, tree, commit and index each time, unless the
+        repo is `staging`: then the node is only recorded in the staging
+        database and the index is updated once by `flush` (which `commit`
+        calls), saving the intermediate objects. See `staged` for reading the
+        nodes back before that.
+        """
+        if self.staging:
+            asserting(index())
+            node = data if isinstance(data, Ref) else self(Node(data, doc=doc))
+            self._stage(index, node, name)
+        else:
+            ctx = Ctx.from_head(index)
+            node = data if isinstance(data, Ref) else self(Node(data, doc=doc))
+            self.flush(index, [(node, name)], ctx=ctx)
+        return node
+
+    def flush(self, index: Ref, entries=(), *, ctx=None):
+        """Write the nodes staged for `index` (and `entries`, a list of (node, name) pairs) to its dag."""
+        staged = self.staged(index)
+        if not len(staged) and not len(entries):
+            return
+        ctx = ctx or Ctx.from_head(index)
+        nodes = persistent_collections(ctx.dag).nodes
+        for node, name in [*staged, *entries]:
+            nodes.add(node)
+            if name:
+                ctx.dag.names[name] = node
         ctx.commit.tree = self(ctx.tree)
         ctx.commit.created = ctx.commit.modified = now()
-        self(index, Index(self(ctx.commit), self(ctx.dag)))
-        return node
+        commit, dag = self(ctx.commit), self(ctx.dag)
+        self(index, Index(commit, dag))
+        self._track(index, [commit, ctx.commit.tree, dag])
+        self._unstage(index)
+
+    def _track(self, index, refs):
+        # Records the objects written for the (intermediate) states of an
+        # index, to be reclaimed when the index is deleted (see `_reclaim`).
+        for ref in refs:
+            self._tx[0].put(f"{index.to}/{ref.to}".encode(), b"", db=self.meta["ephemeral"])
+
+    def _reclaim(self, index):
+        # Deletes the tracked objects of a deleted index which are no longer
+        # referenced (and what only they referenced), so that the states it
+        # went through don't have to wait for `gc`.
+        prefix, refs = f"{index.to}/".encode(), []
+        with self._tx[0].cursor(db=self.meta["ephemeral"]) as cursor:
+            if cursor.set_range(prefix):
+                while bytes(cursor.key()).startswith(prefix):
+                    refs.append(Ref(bytes(cursor.key())[len(prefix) :].decode()))
+                    if not cursor.delete():
+                        break
+        if self._refcounting():
+            self._collect(refs, cascade=True)
+
+    def staged(self, index: Ref):
+        """The (node, name) pairs put to `index` but not flushed to its dag yet, in order."""
+        return next((x for ref, x in self._staging_entries(index) if ref.to == index.to), [])
+
+    def _staging_entries(self, index=None):
+        # Yields (index, entries) pairs. Staging keys are "<index>/<seq>" and
+        # "<index>" holds the next sequence number.
+        if self.meta["staging"] is None:  # eg. not created yet in a read only env
+            return
+        prefix = b"" if index is None else f"{index.to}/".encode()
+        ref, entries = None, []
+        with self._tx[0].cursor(db=self.meta["staging"]) as cursor:
+            if not cursor.set_range(prefix):
+                return
+            for k, v in cursor:
+                k = bytes(k).decode()
+                if not k.startswith(prefix.decode()):
+                    break
+                if k.count("/") < 2:
+                    continue
+                x = Ref(k.rsplit("/", 1)[0])
+                if x != ref and len(entries):
+                    yield ref, entries
+                    entries = []
+                ref = x
+                node, name = unpackb(v)
+                entries.append((node, name))
+        if len(entries):
+            yield ref, entries
+
+    def _stage(self, index, node, name):
+        seq = self._tx[0].get(index.to.encode(), db=self.meta["staging"])
+        seq = 0 if seq is None else int(bytes(seq))
+        self._tx[0].put(f"{index.to}/{seq:012d}".encode(), packb([node, name]), db=self.meta["staging"])
+        self._tx[0].put(index.to.encode(), str(seq + 1).encode(), db=self.meta["staging"])
+        self._update_refcounts(index, None, node)
+
+    def _unstage(self, index):
+        for node, _ in self.staged(index):
+            self._update_refcounts(index, node, None)
+        prefix = f"{index.to}/".encode()
+        with self._tx[0].cursor(db=self.meta["staging"]) as cursor:
+            if cursor.set_range(prefix):
+                while bytes(cursor.key()).startswith(prefix) and cursor.delete():
+                    pass
+        self._tx[0].delete(index.to.encode(), db=self.meta["staging"])
 
     def get_node_value(self, ref: Ref):
         node = self.get(ref)
@@ -819,45 +1918,79 @@ class Repo:
 
     def start_fn(self, index, *, argv, name=None, doc=None):
         fn, *data = map(lambda x: x().datum, argv)
-        if fn.adapter is None:
-            uri = urlparse(fn.uri)
-            assert uri.scheme == "daggerml", f"unexpected URI scheme: {uri.scheme!r} for null adapter"
-            argv_node = self(Node(Argv(self.put_datum([x().value for x in argv]))))
-            result = error = None
-            nodes = [argv_node]
-            try:
-                result = BUILTIN_FNS[uri.path](*data)
-            except Exception as e:
-                error = Error.from_ex(e)
-            else:
-                result = self(Node(Literal(self.put_datum(result))))
-                nodes.append(result)
-            fndag = self(FnDag(nodes, {}, result, error, argv_node().value.id, argv_node))
+        if fn.adapter is not None:
+            fn, cache_key, dump = self.prepare_fn(argv)
+            return self.finish_fn(index, argv, cache_key, self.submit_fn(fn, cache_key, dump), name=name, doc=doc)
+        uri = urlparse(fn.uri)
+        assert uri.scheme == "daggerml", f"unexpected URI scheme: {uri.scheme!r} for null adapter"
+        argv_node = self(Node(Argv(self.put_datum([x().value for x in argv]))))
+        result = error = None
+        nodes = [argv_node]
+        try:
+            result = BUILTIN_FNS[uri.path](*data)
+        except Exception as e:
+            error = Error.from_ex(e)
         else:
-            assert self.cache_path, (
-                "cache path is required for function execution. "
-                "Set the cache path via the DML_CACHE_PATH environment variable or in the config file."
-            )
-            argv_datum = to_json(
-                {
-                    "expr": [self.dump_ref(x().value) for x in argv],
-                    "prepop": {k: self.dump_ref(v) for k, v in fn.prepop.items()},
-                }
-            )
-            cache_key = md5(argv_datum.encode()).hexdigest()
-            with Cache(self.cache_path, create=False) as cache_db:
-                cached_val = cache_db.submit(unroll_datum(fn), cache_key, argv_datum)
-            fndag = self.load_ref(cached_val) if cached_val else None
-            if isinstance(fndag, Error):
-                fndag = self(FnDag([argv], {}, None, fndag, cache_key, argv))
+            result = self(Node(Literal(self.put_datum(result))))
+            nodes.append(result)
+        fndag = self(FnDag(nodes, {}, result, error, argv_node().value.id, argv_node))
+        return self._put_fn(index, fndag, argv, name, doc)
+
+    def prepare_fn(self, argv):
+        """
+        Dump the arguments of a call to a function with an adapter.
+
+        This is the part of `start_fn` that reads the repo before the adapter
+        runs (see `submit_fn`).
+
+        Returns
+        -------
+        A (fn, cache key, dump) tuple, where fn is the unrolled Executable.
+        """
+        assert self.cache_path, (
+            "cache path is required for function execution. "
+            "Set the cache path via the DML_CACHE_PATH environment variable or in the config file."
+        )
+        fn = argv[0]().datum
+        dump = to_json(
+            {
+                "expr": [self.dump_ref(x().value) for x in argv],
+                "prepop": {k: self.dump_ref(v) for k, v in fn.prepop.items()},
+            }
+        )
+        return unroll_datum(fn), cache_hash(dump), dump
+
+    def submit_fn(self, fn, cache_key, dump):
+        """
+        Look up or compute (by calling the adapter) the result of a prepared
+        call (see `prepare_fn`). This doesn't use the repo's transaction, so
+        it can run without holding the write lock.
+        """
+        cache = nullcontext(self._cache) if self._cache else Cache(self.cache_path, **(self.cache_options or {}))
+        with cache as cache_db:
+            return cache_db.submit(fn, cache_key, dump)
+
+    def finish_fn(self, index, argv, cache_key, result, *, name=None, doc=None):
+        """
+        Add the Fn node for the `result` of `submit_fn` to the index. The index
+        is read again here, so changes made to it while the adapter ran are
+        kept (and the call fails if the index is gone).
+        """
+        fndag = self.load_ref(result) if result else None
+        if isinstance(fndag, Error):
+            fndag = self(FnDag([argv], {}, None, fndag, cache_key, argv))
         if fndag is not None:
-            node = self.put_node(Fn(fndag, None, argv), index=index, name=name, doc=doc)
-            raise_ex(self.get(node).error)
-            return node
+            return self._put_fn(index, fndag, argv, name, doc)
+
+    def _put_fn(self, index, fndag, argv, name, doc):
+        node = self.put_node(Fn(fndag, None, argv), index=index, name=name, doc=doc)
+        raise_ex(self.get(node).error)
+        return node
 
     def commit(self, res_or_err, index: Ref):
         result, error = (res_or_err, None) if isinstance(res_or_err, Ref) else (None, res_or_err)
         assert result is not None or error is not None, "both result and error are none"
+        self.flush(index)
         dag = self.get(index).dag
         ctx = Ctx.from_head(index, dag=dag)
         assert (ctx.dag.result or ctx.dag.error) is None, "dag has been committed already"
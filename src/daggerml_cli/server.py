@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack
+from functools import partial
+
+import lmdb
+
+from daggerml_cli import api
+from daggerml_cli.config import Config
+from daggerml_cli.db import Cache
+from daggerml_cli.repo import Error, Ref, Repo, from_json, to_json
+
+logger = logging.getLogger(__name__)
+GROUP_WINDOW = 0.002  # seconds a group commit waits for more writes
+GROUP_SIZE = 64  # the most writes in a group commit
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def request(path, payload):
+    """
+    Send a request to the `dml serve` daemon listening at `path`.
+
+    Returns the response text, or None if no daemon is listening.
+    """
+    if not os.path.exists(path):
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        sock.sendall(payload.encode())
+        sock.shutdown(socket.SHUT_WR)
+        return recv_all(sock).decode()
+
+
+def invoke(config, token, data):
+    """
+    Invoke a DAG builder API op via the `dml serve` daemon.
+
+    Parameters
+    ----------
+    config: Config
+    token: the index token (JSON)
+    data: the op payload (JSON)
+
+    Returns
+    -------
+    The JSON response, or None if no daemon is listening on the config's socket.
+    """
+    if not os.path.exists(config.SOCKET_PATH):
+        return None
+    payload = {
+        "repo_path": config.REPO_PATH,
+        "user": config.USER or "unknown",
+        "head": config.BRANCHREF.to,
+        "cache_path": config.CACHE_PATH or None,
+        "settings": config.SETTINGS,
+        "token": token,
+        "data": data,
+    }
+    return request(config.SOCKET_PATH, json.dumps(payload))
+
+
+def is_map_full(ex):
+    # also a map grown by another process, which is adopted by replaying too (see Repo.transact)
+    while ex is not None:
+        if isinstance(ex, (lmdb.MapFullError, lmdb.MapResizedError)):
+            return True
+        ex = ex.__cause__ or ex.__context__
+    return False
+
+
+class GroupCommit:
+    """
+    Merges concurrent writes to a repo into shared LMDB commits.
+
+    Submitted calls are run one after another by a writer thread. Calls that
+    arrive within `window` seconds of the first (up to `size` of them) run in
+    one write transaction, each in its own nested transaction (see
+    `Repo.joined`), so that the group pays for one durable commit. A call that
+    fails is rolled back on its own, and each caller gets its result only
+    once the group is committed. Calls that run out of map space (or whose
+    group fails to commit) are run again on their own.
+    """
+
+    def __init__(self, repo, window=GROUP_WINDOW, size=GROUP_SIZE):
+        self.repo = repo
+        self.window = window
+        self.size = size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, session, fn, *args, **kwargs):
+        """Call `fn(*args, **kwargs)` in a group commit with `session` (a session of the repo) joined to it."""
+        future = Future()
+        self._queue.put((session, partial(fn, *args, **kwargs), future))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        done = False
+        while not done:
+            jobs = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while jobs[-1] is not None and len(jobs) < self.size:
+                try:
+                    jobs.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if jobs[-1] is None:
+                done = jobs.pop() is None
+            if jobs:
+                self._commit(jobs)
+
+    def _commit(self, jobs):
+        results, retry = [], []
+        try:
+            with self.repo.tx(True, atomic=True):
+                parent = self.repo._tx[0]
+                for i, (db, fn, future) in enumerate(jobs):
+                    try:
+                        with db.joined(parent):
+                            results.append((future, fn(), None))
+                    except Exception as e:
+                        if is_map_full(e):
+                            retry = jobs[i:]
+                            break
+                        results.append((future, None, e))
+        except Exception:
+            logger.exception("group commit failed, retrying its writes one by one")
+            results, retry = [], jobs
+        for future, result, ex in results:
+            future.set_exception(ex) if ex is not None else future.set_result(result)
+        for _, fn, future in retry:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        req = self.rfile.read()
+        if not req:
+            return
+        try:
+            req = json.loads(req.decode())
+            db = self.server.session(req)
+            resp = to_json(self.server.invoke(req["repo_path"], db, from_json(req["token"]), from_json(req["data"])))
+        except Exception as e:
+            resp = to_json(Error.from_ex(e))
+        self.wfile.write(resp.encode())
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves `invoke_api` requests over a unix socket.
+
+    Repo and cache environments are opened on first use and kept open until
+    the server is closed, with the storage settings (see Config.SETTINGS) of
+    the request that opened them. The staging, cache compression and cache
+    eviction settings apply per request. Each request runs in its own thread
+    with its own Repo session (see `Repo.session`). Requests which write to
+    the repo (other than by calling adapters) are group committed (see
+    GroupCommit), unless `group_window` is None.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, group_window=GROUP_WINDOW, group_size=GROUP_SIZE):
+        if request(path, "") is not None:
+            raise RuntimeError(f"server already running: {path}")
+        if os.path.exists(path):
+            os.remove(path)  # stale socket
+        self._lock = threading.Lock()
+        self._stack = ExitStack()
+        self.group_window = group_window
+        self.group_size = group_size
+        self.repos = {}
+        self.caches = {}
+        self.committers = {}
+        super().__init__(path, Handler)
+
+    def repo(self, path, options=None):
+        with self._lock:
+            if path not in self.repos:
+                self.repos[path] = repo = self._stack.enter_context(Repo(path, **(options or {})))
+                flags = repo.env.flags()
+                # nested transactions are not available with writemap (nor needed without sync)
+                if self.group_window is not None and not (flags["readonly"] or flags["writemap"]):
+                    self.committers[path] = GroupCommit(repo, self.group_window, self.group_size)
+                    self._stack.callback(self.committers[path].close)
+            return self.repos[path]
+
+    def cache(self, path, options=None):
+        with self._lock:
+            if path not in self.caches:
+                self.caches[path] = self._stack.enter_context(Cache(path, **(options or {})))
+            return self.caches[path]
+
+    def session(self, req):
+        config = Config.new(**req.get("settings") or {})
+        options, cache_options = config.REPO_OPTIONS, config.CACHE_OPTIONS
+        cache_path = req["cache_path"]
+        cache = None
+        if cache_path:
+            session_options = {k: cache_options.pop(k) for k in ["compression", "eviction"]}
+            cache = self.cache(cache_path, cache_options).session(**session_options)
+        staging = bool(options.pop("staging"))
+        repo = self.repo(req["repo_path"], options)
+        kw = {"user": req["user"], "head": Ref(req["head"]), "staging": staging}
+        return repo.session(**kw, cache_path=cache_path, cache=cache)
+
+    def invoke(self, repo_path, db, token, data):
+        committer = self.committers.get(repo_path)
+        ops = data if api.is_batch(data) else [data]
+        reads = all(op in api.READ_OPS for op, *_ in ops)  # reads don't wait for writes
+        if committer is None or reads or any(op == "start_fn" for op, *_ in ops):  # adapters can run for long
+            return api.invoke_api(None, token, data, db=db)
+        return committer.submit(db, api.invoke_api, None, token, data, db=db)
+
+    def server_close(self):
+        super().server_close()
+        self._stack.close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def serve(path):
+    def stop(*_):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    with Server(path) as server:
+        logger.info("listening on %s", path)
+        server.serve_forever()
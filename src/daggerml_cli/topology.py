@@ -43,12 +43,13 @@ def make_edges(ref):
 
 def topology(db, ref):
     dag = ref()
+    names = {v: k for k, v in dag.names.items()}
     edges = flatten([make_edges(x) for x in dag.nodes])
     return {
         "id": ref,
         "argv": dag.argv.to if hasattr(dag, "argv") else None,
         "cache_key": getattr(dag, "cache_key", None),
-        "nodes": [make_node(dag.nameof(x), x) for x in dag.nodes],
+        "nodes": [make_node(names.get(x), x) for x in dag.nodes],
         "edges": edges,
         "result": dag.result.to if dag.result is not None else None,
         "error": None if dag.error is None else str(dag.error),
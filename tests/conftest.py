@@ -11,8 +11,10 @@ def setup_envvars():
     with patch.dict(os.environ):
         # Clear AWS environment variables before any tests run
         for k in os.environ:
-            if k.startswith("AWS_") or k.startswith("DML_"):
+            if k.startswith("AWS_") or (k.startswith("DML_") and k != "DML_STORAGE"):
                 del os.environ[k]
         os.environ["AWS_SHARED_CREDENTIALS_FILE"] = "/dev/null"
         os.environ["PYTHONPATH"] = "."  # ensure `tests` is in PYTHONPATH
-        yield
+        # DML_STORAGE runs the whole suite against another storage backend
+        with patch("daggerml_cli.db.DEFAULT_STORAGE", os.getenv("DML_STORAGE", "lmdb")):
+            yield
@@ -2,12 +2,14 @@ import os
 from tempfile import TemporaryDirectory
 from unittest import TestCase, mock
 
+import lmdb
 import pytest
 
 from daggerml_cli import api
+from daggerml_cli.api import OpResult
 from daggerml_cli.config import Config
-from daggerml_cli.db import CacheError
-from daggerml_cli.repo import Error, Executable, FnDag, Node, Ref, Resource
+from daggerml_cli.db import Cache, CacheError
+from daggerml_cli.repo import Error, Executable, FnDag, Node, Ref, Repo, Resource
 from tests.util import SimpleApi
 
 SUM = Executable("./tests/fn/sum.py", adapter="dml-python-fork-adapter")
@@ -77,6 +79,19 @@ class TestApiBase(TestCase):
             assert d0.unroll(result)[1] == 3
             d0.test_close(self)
 
+    def test_fn_adapter_outside_tx(self):
+        submit, active = Cache.submit, []
+
+        def check(cache, *args):
+            active.append(Repo.current())
+            return submit(cache, *args)
+
+        with SimpleApi.begin() as d0:
+            with mock.patch.object(Cache, "submit", check):
+                result = d0.start_fn(SUM, 1, 2)
+            assert active == [None]  # the adapter ran without holding the repo's write lock
+            assert d0.unroll(result)[1] == 3
+
     def test_fn_adapter_err(self):
         with SimpleApi.begin() as d0:
             with pytest.raises(Error, match="test error") as exc:
@@ -184,7 +199,17 @@ class TestApiBase(TestCase):
                 assert len(cache) == len(nodes)
                 with d0.tx():
                     assert {x().data.dag.to for x in nodes} == {x["dag_id"] for x in cache}
-                assert [api.info_cache(d0.ctx, x["cache_key"]) for x in cache] == cache
+                for x in cache:
+                    info = api.info_cache(d0.ctx, x["cache_key"])
+                    assert info["cache_key"] == x["cache_key"]
+                    assert (info["error"], info["dag_id"]) == (x["error"], x["dag_id"])
+                    assert x["size"] <= len(info["data"])  # as stored (see Cache.compression)
+                assert {(x["adapter"], x["uri"]) for x in cache} == {(SUM.adapter, SUM.uri)}
+                assert api.list_cache(d0.ctx, uri=SUM.uri) == cache
+                assert api.list_cache(d0.ctx, adapter="nope") == []
+                pages = [api.list_cache(d0.ctx, limit=2), api.list_cache(d0.ctx, after=cache[1]["cache_key"])]
+                assert [len(x) for x in pages] == [2, 1]
+                assert pages[0] + pages[1] == cache
                 api.delete_cache(d0.ctx, cache[0]["cache_key"])
                 cache = api.list_cache(d0.ctx)
                 assert len(cache) == len(nodes) - 1
@@ -201,6 +226,7 @@ class TestApiBase(TestCase):
                     api.put_cache(d0.ctx, dag)
                 api.delete_cache(d0.ctx, api.list_cache(d0.ctx)[0]["cache_key"])
                 api.put_cache(d0.ctx, dag)
+                assert [x["uri"] for x in api.list_cache(d0.ctx, adapter=SUM.adapter)] == [SUM.uri]
                 c = d0.start_fn(SUM, 1, 2, 3)
                 a_ = d0.unroll(a)
                 b_ = d0.unroll(b)
@@ -321,6 +347,71 @@ class TestApiBase(TestCase):
             ["executable", "int", "str", "error", "nonetype"],
         )
 
+    def test_batch(self):
+        with SimpleApi.begin() as d0:
+            n0, n1, n2 = d0.batch(
+                ["put_literal", [1], {"name": "n0"}],
+                ["put_literal", [[OpResult(0), 2]], {}],
+                ["start_fn", [], {"argv": [SUM, OpResult(0), 2], "name": "n2"}],
+            )
+            assert d0.unroll(n0) == 1
+            assert d0.unroll(n1) == [1, 2]
+            assert d0.unroll(n2)[1] == 3
+            assert d0.get_node("n0") == n0
+            assert d0.get_node("n2") == n2
+            assert d0.batch() == []
+            d0.commit(n2)
+            d0.test_close(self)
+
+    def test_staging(self):
+        with SimpleApi.begin() as d0:
+            d0.ctx._STAGING = True
+            n0 = d0.put_literal(1, name="n0")
+            n1 = d0.put_literal([n0, 2])
+            d0.set_node("n1", n1)
+            assert d0.get_names() == {"n0": n0, "n1": n1}
+            assert d0.get_node("n1") == n1
+            assert d0.get_node(n0.to) == n0
+            with d0.tx() as db:
+                assert n1 in [x for x, _ in db.staged(d0.token)]
+                assert len(d0.token().dag().nodes) == 0
+            d0.commit(n1)
+            d0.test_close(self)
+
+    def test_batch_atomic(self):
+        with SimpleApi.begin() as d0:
+            with self.assertRaisesRegex(Error, "no such op: bogus"):
+                d0.batch(
+                    ["put_literal", [1], {"name": "n0"}],
+                    ["bogus", [OpResult(0)], {}],
+                )
+            assert d0.get_names() == {}
+            n0 = d0.put_literal(1, name="n0")
+            assert d0.get_names() == {"n0": n0}
+
+    def test_map_full_replay(self):
+        with SimpleApi.begin() as d0:
+            ops = {
+                "gc": lambda: api.gc_repo(d0.ctx),
+                "migrate_hash": lambda: api.migrate_hash_repo(d0.ctx, "blake2b"),
+                "begin": lambda: api.begin_dag(d0.ctx, name="d1", message="d1"),
+                "create_branch": lambda: api.create_branch(d0.ctx, "b1"),
+                "merge": lambda: api.merge_branch(d0.ctx, "main"),
+                "rebase": lambda: api.rebase_branch(d0.ctx, "main"),
+            }
+            for name, op in ops.items():
+                calls, orig = [], getattr(Repo, name)
+
+                def fill_once(db, *args, orig=orig, calls=calls, **kwargs):
+                    calls.append(None)
+                    if len(calls) == 1:
+                        raise lmdb.MapFullError("mdb_put: MDB_MAP_FULL: Environment mapsize limit reached")
+                    return orig(db, *args, **kwargs)
+
+                with mock.patch.object(Repo, name, fill_once):
+                    op()
+                assert len(calls) == 2, name
+
     def test_backtrack_node(self):
         with SimpleApi.begin("d0") as d0:
             n0 = d0.put_literal(42)
@@ -11,6 +11,7 @@ import click
 import pytest
 from click.testing import CliRunner
 
+from daggerml_cli.api import OpResult
 from daggerml_cli.cli import cli, from_json, jsdumps, to_json
 from daggerml_cli.repo import Executable, Resource
 
@@ -193,6 +194,35 @@ class TestCliDag(TestCase):
             desc2 = dml.json("dag", "describe", desc["id"])
             assert desc == desc2
 
+    def test_ref_describe_dag(self):
+        with cliTmpDirs() as dml:
+            dml.config_user("Testy McTesterstein")
+            dml.repo_create("repo0")
+            dml.config_repo("repo0")
+            d0 = dml.dag_create("d0", "dag d0")
+            node = from_json(d0("put_literal", data=23, name="x"))
+            d0("commit", result=node)
+            dag_id = dml.json("dag", "describe", "d0")["id"]
+            desc = dml.json("ref", "describe", "dag", dag_id.split("/", 1)[1])
+            assert desc["nodes"] == [node.to]
+            assert desc["names"] == {"x": node.to}
+            tree_id = dml.json("commit", "list")[0]["tree"]
+            desc = dml.json("ref", "describe", "tree", tree_id.split("/", 1)[1])
+            assert desc["dags"] == {"d0": dag_id}
+
+    def test_dag_batch(self):
+        with cliTmpDirs() as dml:
+            dml.config_user("Testy McTesterstein")
+            dml.repo_create("repo0")
+            dml.config_repo("repo0")
+            d0 = dml.dag_create("d0", "dag d0")
+            ops = [["put_literal", [23], {"name": "x"}], ["commit", [OpResult(0)], {}]]
+            resp = from_json(dml("api", "invoke", d0._token, input=to_json(ops)))
+            assert len(resp) == 2
+            desc = dml.json("dag", "describe", "d0")
+            assert desc["result"] == resp[0].to
+            assert desc["nodes"][0]["name"] == "x"
+
     def test_dag_list(self):
         with cliTmpDirs() as dml:
             dml.config_user("Testy McTesterstein")
@@ -297,6 +327,9 @@ class TestCliRepo(TestCase):
             d0("commit", result=from_json(d0("put_literal", data=v0)))
             dml.config_branch("main")
             dml.branch_delete("b0")
+            resp = dml("repo", "gc", "--limit", "1")
+            lines = [[y for y in x.split() if y] for x in resp.split("\n") if x]
+            assert sum(int(x[1]) for x in lines[1:]) <= 1
             resp = dml("repo", "gc")
             lines = [[y for y in x.split() if y] for x in resp.split("\n") if x]
             assert lines.pop(0) == ["object", "deleted", "remaining"]
@@ -307,6 +340,20 @@ class TestCliRepo(TestCase):
             lines = [[y for y in x.split() if y] for x in resp.split("\n") if x]
             assert all(x[1].strip() == "0" for x in lines[1:])
 
+    def test_repo_migrate_hash(self):
+        with cliTmpDirs() as dml:
+            dml.config_user("Testy McTesterstein")
+            dml.repo_create("repo0")
+            dml.config_repo("repo0")
+            d0 = dml.dag_create("d0", "dag d0")
+            d0("commit", result=from_json(d0("put_literal", data=[1, 2], name="x")))
+            desc0 = dml.json("dag", "describe", "d0")
+            assert dml("repo", "migrate-hash", "blake2b").startswith("Migrated ")
+            desc1 = dml.json("dag", "describe", "d0")
+            assert desc1["id"] != desc0["id"]
+            assert [x["name"] for x in desc1["nodes"]] == ["x"]
+            assert dml("repo", "migrate-hash", "blake2b") == "Migrated 0 objects to: blake2b"
+
     def test_repo_list(self):
         with cliTmpDirs() as dml:
             dml.config_user("Testy McTesterstein")
@@ -3,6 +3,7 @@ from tempfile import TemporaryDirectory
 from unittest import TestCase, mock
 
 from daggerml_cli.config import Config, ConfigError
+from daggerml_cli.db import Eviction, MapGrowth
 from daggerml_cli.repo import Ref
 
 
@@ -91,3 +92,16 @@ class TestConfig(TestCase):
                 assert config.BRANCHREF == Ref(to="head/master")
                 assert config.REPO_DIR == f"{config_dir}/repo"
                 assert config.REPO_PATH == f"{config_dir}/repo/test0"
+
+    def test_settings(self):
+        config = Config.new(staging=True, cache_compression="none", cache_eviction="policy=cost,ttl=60")
+        assert config.SETTINGS["staging"] is True
+        assert config.SETTINGS["durability"] is None
+        assert config.REPO_OPTIONS["staging"] is True
+        assert config.REPO_OPTIONS["map_growth"] is None
+        assert config.REPO_OPTIONS["cache_options"] == config.CACHE_OPTIONS
+        assert config.CACHE_OPTIONS["compression"] == "none"
+        assert config.CACHE_OPTIONS["eviction"] == Eviction(policy="cost", ttl=60.0)
+        config = Config.new(**{**config.SETTINGS, "map_growth": "factor=3"})  # eg. as sent to `dml serve`
+        assert config.REPO_OPTIONS["map_growth"] == MapGrowth(factor=3.0)
+        assert config.CACHE_OPTIONS["eviction"] == Eviction(policy="cost", ttl=60.0)
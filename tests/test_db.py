@@ -1,7 +1,19 @@
+import json
+import os
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import patch
+
+import lmdb
 
 from daggerml_cli import db
+from daggerml_cli.repo import Executable
+
+FN = Executable("foo://bar", adapter="ls")
 
 
 class TestCache(unittest.TestCase):
@@ -16,7 +28,7 @@ class TestCache(unittest.TestCase):
     def test_resize(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             cache_path = f"{tmpdir}/cache.db"
-            with db.Cache(cache_path, create=True) as cache:
+            with db.Cache(cache_path, create=True, storage="lmdb") as cache:
                 initial_size = cache.env.info()["map_size"]
 
                 def call_fn(tx):
@@ -27,6 +39,251 @@ class TestCache(unittest.TestCase):
                 new_size = cache.env.info()["map_size"]
                 self.assertGreater(new_size, initial_size)
 
+    def test_resize_waits_for_transactions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True, storage="lmdb", compression="none") as cache:
+                initial_size = cache.env.info()["map_size"]
+                thread = threading.Thread(target=cache.put, args=("big", "x" * initial_size))
+                with cache.tx() as tx:
+                    thread.start()
+                    thread.join(0.5)
+                    self.assertTrue(thread.is_alive())  # the map isn't resized under an open transaction
+                    self.assertIsNone(tx.get(b"big"))
+                thread.join()
+                self.assertGreater(cache.env.info()["map_size"], initial_size)
+                self.assertEqual(cache.get("big"), "x" * initial_size)
+
+    def test_resize_holds_off_new_transactions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                resizer, events = cache._resizer, []
+                with resizer.active():
+                    grower = threading.Thread(target=lambda: (resizer.grow(force=True), events.append("grown")))
+                    grower.start()
+                    while not resizer._growing:
+                        time.sleep(0.01)
+                    reader = threading.Thread(target=lambda: events.append(cache.get("key")))
+                    reader.start()
+                    with resizer.active():  # a thread's nested registrations don't wait
+                        time.sleep(0.1)
+                    self.assertEqual(events, [])
+                grower.join()
+                reader.join()
+                self.assertEqual(events, ["grown", None])
+
+    def test_map_resized_by_other_process(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with patch.object(db, "MAP_SIZE_MIN", 1 << 22):
+                cache = db.Cache(f"{tmpdir}/cache.db", create=True, storage="lmdb")
+            with cache:
+                code = "import sys; from daggerml_cli import db\n"
+                code += "with db.Cache(sys.argv[1], storage='lmdb', compression='none') as c: c.put('big', 'x' * 2**24)"
+                env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+                subprocess.run([sys.executable, "-c", code, cache.path], check=True, env=env)
+                self.assertEqual(cache.get("big"), "x" * 2**24)  # the grown map is adopted
+                cache.put("small", "x")
+
+    def test_memory_storage(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = db.open_env(f"{tmpdir}/env", "memory")
+            sub = env.open_db(b"db/sub")
+            with env.begin(write=True) as tx:
+                for k in [b"b", b"a/1", b"a/2", b"c"]:
+                    tx.put(k, k.upper(), db=sub)
+                tx.put(b"main", b"1")
+            reader = env.begin()
+            with self.assertRaises(RuntimeError):
+                with env.begin(write=True) as tx:
+                    tx.delete(b"c", db=sub)
+                    raise RuntimeError("aborted")
+            with env.begin(write=True) as tx:
+                with env.begin(write=True, parent=tx) as child:
+                    child.put(b"d", b"D", db=sub)
+                self.assertEqual(tx.get(b"d", db=sub), b"D")
+                with tx.cursor(db=sub) as cursor:
+                    self.assertTrue(cursor.set_range(b"a/"))
+                    while bytes(cursor.key()).startswith(b"a/") and cursor.delete():
+                        pass
+                    self.assertEqual(cursor.key(), b"b")
+            self.assertEqual(
+                list(reader.cursor(db=sub)), [(b"a/1", b"A/1"), (b"a/2", b"A/2"), (b"b", b"B"), (b"c", b"C")]
+            )
+            with env.begin() as tx:
+                self.assertEqual(list(tx.cursor(db=sub).iternext(values=False)), [b"b", b"c", b"d"])
+                self.assertEqual(tx.get(b"main"), b"1")
+                self.assertEqual(tx.stat(sub)["entries"], 3)
+                with self.assertRaises(lmdb.ReadonlyError):
+                    tx.put(b"x", b"y")
+            reopened = db.open_env(f"{tmpdir}/env", "memory", readonly=True)
+            self.assertEqual(reopened.begin().get(b"d", db=reopened.open_db(b"db/sub", create=False)), b"D")
+            with self.assertRaises(lmdb.NotFoundError):
+                reopened.open_db(b"db/nope", create=False)
+            with self.assertRaisesRegex(ValueError, "unknown storage backend: 'nope'"):
+                db.open_env(f"{tmpdir}/env", "nope")
+
+    def test_submit_leases(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                calls, results = [], []
+
+                def run(*_, **kw):
+                    calls.append(kw["env"]["DML_CACHE_KEY"])
+                    cache.put("other", "written by the adapter")  # no lock is held meanwhile
+                    time.sleep(0.2)
+                    return subprocess.CompletedProcess([], 0, stdout="result", stderr="")
+
+                def call():
+                    results.append(cache.submit(FN, "k", "{}"))
+
+                with patch("subprocess.run", side_effect=run):
+                    threads = [threading.Thread(target=call) for _ in range(3)]
+                    [x.start() for x in threads]
+                    [x.join() for x in threads]
+                self.assertEqual(calls, ["k"])  # the others waited for the first call
+                self.assertEqual(results, ["result"] * 3)
+                self.assertEqual(cache.get("other"), "written by the adapter")
+                with cache.tx() as tx:
+                    self.assertIsNone(tx.get(b"k", db=cache.dbs["leases"]))
+                [stats] = cache.stats()
+                self.assertEqual(
+                    {k: stats[k] for k in ["adapter", "uri", "hits", "misses", "waits", "bytes"]},
+                    {"adapter": "ls", "uri": "foo://bar", "hits": 2, "misses": 1, "waits": 2, "bytes": 6},
+                )
+                self.assertGreaterEqual(stats["wall_time"], 0.2)
+                self.assertGreater(stats["wait_time"], 0)
+                self.assertAlmostEqual(stats["hit_rate"], 2 / 3)
+
+    def test_submit_stale_lease(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                proc = subprocess.Popen(["true"])
+                proc.wait()
+                dead = {"id": "x", "pid": proc.pid, "host": db.socket.gethostname(), "expires": time.time() + 60}
+                expired = {**dead, "pid": os.getpid(), "expires": 0}
+                failed = subprocess.CompletedProcess([], 1, stdout="", stderr="oops")
+                for lease in [dead, expired]:
+                    with cache.tx(True) as tx:
+                        tx.put(b"k", json.dumps(lease).encode(), db=cache.dbs["leases"])
+                    with patch("subprocess.run", return_value=failed):
+                        with self.assertRaisesRegex(AssertionError, "exit status: 1"):
+                            cache.submit(FN, "k", "{}")
+                    with cache.tx() as tx:
+                        self.assertIsNone(tx.get(b"k", db=cache.dbs["leases"]))  # released on failure too
+                [stats] = cache.stats()
+                self.assertEqual([stats[k] for k in ["hits", "misses", "waits", "errors", "bytes"]], [0, 2, 0, 2, 0])
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                with patch("time.time", return_value=100.0):
+                    cache.put("old", "x" * 10)
+                with patch("time.time", return_value=200.0):
+                    cache.put("big", "x" * 100)
+                    cache._release("slow", None, "x" * 100, cost=60.0)
+                    cache._release("fast", None, "x" * 10, cost=1.0)
+                with patch("time.time", return_value=300.0):
+                    self.assertEqual(cache.submit(FN, "old", "{}"), "x" * 10)  # a hit counts as an access
+                with cache.tx() as tx:
+                    self.assertEqual(cache._meta(tx, "size"), 220)
+                with patch("time.time", return_value=350.0):
+                    self.assertEqual(cache.evict(db.Eviction(ttl=120)), ["big", "fast", "slow"])
+                    self.assertEqual(cache.evict(db.Eviction(ttl=120)), [])
+                self.assertEqual([k for k in ["old", "big", "slow", "fast"] if cache.get(k)], ["old"])
+                with cache.tx() as tx:
+                    self.assertEqual(cache._meta(tx, "size"), 10)
+
+    def test_async_cost(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                for t, stdout in [(100.0, ""), (150.0, ""), (200.0, "result")]:  # still running until t=200
+                    done = subprocess.CompletedProcess([], 0, stdout=stdout, stderr="")
+                    with patch("time.time", return_value=t), patch("subprocess.run", return_value=done):
+                        self.assertEqual(cache.submit(FN, "k", "{}"), stdout)
+                    self.assertEqual(cache.get("k"), stdout or None)
+                with cache.tx() as tx:
+                    self.assertEqual(json.loads(bytes(tx.get(b"k", db=cache.dbs["entries"])))["cost"], 100.0)
+                    self.assertIsNone(tx.get(b"k", db=cache.dbs["pending"]))
+                [stats] = cache.stats()
+                self.assertEqual([stats[k] for k in ["hits", "misses", "polls", "errors"]], [0, 1, 2, 0])
+
+    def test_evict_max_size(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                for i, (key, cost) in enumerate([("slow", 60.0), ("fast", 1.0), ("slower", 600.0)]):
+                    with patch("time.time", return_value=100.0 + i):
+                        cache._release(key, None, "x" * 100, cost)
+                lru = db.Eviction(max_size=250)
+                cost = db.Eviction(policy="cost", max_size=150)
+                self.assertEqual(cache.evict(lru), ["slow"])
+                self.assertEqual(cache.evict(cost), ["fast"])
+                with cache.tx() as tx:
+                    self.assertEqual(cache._meta(tx, "clock"), 0.01)  # the priority of "fast"
+                cache.eviction = db.Eviction(max_size=250, headroom=0.2)
+                cache.put("a", "x" * 100)
+                cache.put("b", "x" * 100)  # over max_size: evicts down to 200 bytes
+                self.assertEqual([k for k in ["slower", "a", "b"] if cache.get(k)], ["a", "b"])
+
+    def test_eviction_parse(self):
+        self.assertEqual(db.Eviction.parse(None), db.Eviction())
+        self.assertEqual(
+            db.Eviction.parse("policy=cost, max_size=1e9, ttl=60"), db.Eviction(policy="cost", max_size=10**9, ttl=60)
+        )
+        with self.assertRaisesRegex(ValueError, "unknown eviction setting: nope"):
+            db.Eviction.parse("nope=1")
+        with self.assertRaisesRegex(ValueError, "unknown eviction policy: 'lfu'"):
+            db.Eviction.parse("policy=lfu")
+
+    def test_list_index(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True) as cache:
+                with cache.tx(True) as tx:  # as stored before the cache kept metadata
+                    tx.put(b"a", json.dumps(["Error", {}]).encode())
+                    tx.put(b"b", b"not a dump")
+                    tx.delete(b"indexed", db=cache.dbs["meta"])
+            with db.Cache(f"{tmpdir}/cache.db") as cache:
+                cache._release("c", None, "x" * 10, 1.0, FN)
+                self.assertEqual(
+                    [(x["cache_key"], x["error"], x["adapter"], x["size"]) for x in cache.list()],
+                    [("a", True, None, 13), ("b", None, None, 10), ("c", None, "ls", 10)],
+                )
+                self.assertEqual([x["cache_key"] for x in cache.list(adapter="ls")], ["c"])
+                self.assertEqual([x["cache_key"] for x in cache.list(after="a", limit=1)], ["b"])
+                with patch.object(db, "LIST_PAGE", 2):
+                    self.assertEqual([x["cache_key"] for x in cache], ["a", "b", "c"])
+                with cache.tx() as tx:
+                    self.assertEqual(cache._meta(tx, "size"), 33)
+
+    def test_compression(self):
+        dump = json.dumps([["Ref", "a" * 32]] * 100)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with db.Cache(f"{tmpdir}/cache.db", create=True, compression="zlib", compress_threshold=100) as cache:
+                cache.put("big", dump)
+                cache.put("small", "x" * 99)
+                cache._release("fn", None, dump, 1.0, FN)
+                with cache.tx() as tx:
+                    stored = {k: bytes(tx.get(k.encode())) for k in ["big", "small", "fn"]}
+                self.assertTrue(stored["big"].startswith(b"\0zlib\0"))
+                self.assertLess(len(stored["big"]), len(dump) / 10)
+                self.assertEqual(stored["small"], b"x" * 99)  # under the threshold
+                self.assertEqual(stored["fn"], stored["big"])
+                self.assertEqual(cache.get("big"), dump)
+                self.assertEqual(cache.submit(FN, "fn", "{}"), dump)
+                self.assertEqual(cache.list(after="big", limit=1)[0]["size"], len(stored["big"]))
+                self.assertEqual(cache.stats()[0]["bytes"], len(stored["fn"]))
+                cache.put("big", "new", old_value=dump)
+                self.assertEqual(cache.get("big"), "new")
+            with db.Cache(f"{tmpdir}/cache.db", compression="none", compress_threshold=100) as cache:
+                self.assertEqual(cache.get("fn"), dump)
+                cache.put("plain", dump)
+                with cache.tx() as tx:
+                    self.assertEqual(bytes(tx.get(b"plain")), dump.encode())
+        with self.assertRaisesRegex(ValueError, "unknown cache compression: 'nope'"):
+            db.Cache(f"{tmpdir}/cache.db", compression="nope")
+        noise = os.urandom(200)
+        self.assertEqual(db.compress_value(noise, "zlib", 100), noise)  # not worth compressing
+        with self.assertRaisesRegex(db.CacheError, "unavailable algorithm: lz4"):
+            db.decompress_value(b"\0lz4\0...")
+
     def test_delete(self):
         with tempfile.TemporaryDirectory() as tmpdir:
             cache_path = f"{tmpdir}/cache.db"
@@ -52,3 +309,18 @@ class TestCache(unittest.TestCase):
                 with self.assertRaises(db.CacheError):
                     cache.put("key", "new_value")
                 assert cache.get("key") == val
+
+    def test_durability(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = f"{tmpdir}/cache.db"
+            with db.Cache(cache_path, create=True, durability="fast") as cache:
+                flags = cache.env.flags()
+                self.assertFalse(flags["sync"])
+                self.assertTrue(flags["map_async"])
+                cache.put("key", "value")
+            with db.Cache(cache_path, durability="readonly") as cache:
+                self.assertEqual(cache.get("key"), "value")
+                with self.assertRaises(lmdb.ReadonlyError):
+                    cache.put("key2", "value")
+            with self.assertRaisesRegex(ValueError, "unknown durability profile: 'nope'"):
+                db.Cache(cache_path, durability="nope")
@@ -1,19 +1,48 @@
 import json
+import os
+import random
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+from collections import Counter
 from contextlib import contextmanager
 from unittest.mock import patch
 
+import lmdb
 import pytest
 
-from daggerml_cli.repo import Executable, Literal, Node, Ref, Repo, Resource, unroll_datum
+from daggerml_cli.db import MapGrowth
+from daggerml_cli.pack import packb
+from daggerml_cli.repo import (
+    HASH_ALGOS,
+    NONE,
+    Commit,
+    Dag,
+    Datum,
+    Executable,
+    Head,
+    Literal,
+    Node,
+    PMap,
+    PSet,
+    Ref,
+    Repo,
+    Resource,
+    Tree,
+    from_json,
+    iter_refs,
+    to_json,
+    unroll_datum,
+)
 
 
 @contextmanager
-def tmp_repo(cache_path=None):
+def tmp_repo(cache_path=None, **kwargs):
     """Context manager to create a temporary repository."""
     tmpdirs = [tempfile.mkdtemp() for _ in range(2)]
-    repo = Repo(tmpdirs[0], user="test", create=True, cache_path=cache_path or tmpdirs[1])
+    repo = Repo(tmpdirs[0], user="test", create=True, cache_path=cache_path or tmpdirs[1], **kwargs)
     if cache_path is None:
         assert repo.cache_path is not None
         with Repo(repo.cache_path, create=True):
@@ -138,8 +167,561 @@ def test_adapter_called_correctly():
     assert isinstance(payload["cache_key"], str)
     assert isinstance(payload["dump"], str)
     # check to ensure the dump is loadable
-    with tmp_repo() as repo:
+    with tmp_repo(hash_algo="blake2b") as repo:
         with repo.tx(True):
             ref = repo.begin(message="foo", dump=payload["dump"])
             assert isinstance(ref, Ref)
             assert unroll_datum(ref().dag().argv().value) == argv
+            assert ref().dag().cache_key == payload["cache_key"]  # whichever hash algo the repos use
+
+
+def test_put_is_content_addressed():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            datum = repo.put_datum({"a": [1, 2, {"b": None}], "c": {1, 2}})
+            node = repo(Node(Literal(datum), doc="doc"))
+            objs = [datum(), node(), Dag([node, node], {"x": node}, node, None)]
+            for obj in objs:
+                ref = repo(obj)
+                assert ref.id == repo.hash(obj)
+                assert repo.get(ref) == obj
+            head = Head(node)
+            assert repo(head) != repo(head)  # heads are not content-addressed
+
+
+@pytest.mark.parametrize("algo", sorted(HASH_ALGOS))
+def test_hash_algo(algo):
+    tmpd = tempfile.mkdtemp()
+    try:
+        with Repo(tmpd, user="test", create=True, hash_algo=algo) as repo:
+            with repo.tx(True):
+                ref = repo.put_datum("foo")
+                assert ref.id == HASH_ALGOS[algo](packb(ref(), True))
+        with Repo(tmpd) as repo:
+            assert repo.hash_algo == algo
+    finally:
+        shutil.rmtree(tmpd)
+
+
+def test_migrate_hash():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            index = repo.begin(message="test dag", name="test")
+            nodes = [repo.put_node(Literal(repo.put_datum(x)), index=index) for x in [1, [2, 3], {"a": {4}}]]
+            repo.put_node(Literal(repo.put_datum(Executable("foo:bar", data={"x": 5}))), index=index, name="exe")
+            repo.commit(nodes[-1], index)
+            repo.begin(message="open dag", name="open")
+            before = repo.reachable_objects()
+            garbage = repo.unreachable_objects()
+            dag = repo.get_dag("test")
+            values = sorted(repr(unroll_datum(x().value)) for x in dag().nodes)
+        with repo.tx(True):
+            migrated = repo.migrate_hash("blake2b")
+        with repo.tx():
+            assert sum(migrated.values()) == len([x for x in repo.objects() if x.type not in ["head", "index"]])
+            assert repo.hash_algo == "blake2b"
+            after = repo.reachable_objects()
+            assert len(after) == len(before)
+            assert {x for x in after & before if x.type not in ["head", "index"]} == set()
+            for ref in after:
+                if ref.type not in ["head", "index"]:
+                    assert ref.id == repo.hash(ref())
+            dag = repo.get_dag("test")
+            assert sorted(repr(unroll_datum(x().value)) for x in dag().nodes) == values
+            assert [x.to for x in dag().nodes] == sorted(x.to for x in dag().nodes)
+            assert len(repo.indexes()) == 1
+            assert len(repo.unreachable_objects()) == len(garbage)
+
+
+def test_migrate_hash_other_process():
+    with tmp_repo() as repo:
+        other = Repo(repo.path, user="test", cache_path=repo.cache_path)  # eg. a long running dml serve
+        try:
+            with repo.tx(True):
+                repo.migrate_hash("blake2b")
+            staged = other.stage_datum("y")  # before any transaction of `other`
+            assert staged.ref.id == HASH_ALGOS["blake2b"](packb(Datum("y"), True))
+            with other.tx(True):
+                assert other.hash_algo == "blake2b"
+                assert other.put_staged(staged) == staged.ref
+                ref = other.put_datum("x")
+                assert ref.id == HASH_ALGOS["blake2b"](packb(other.get(ref), True))
+        finally:
+            other.close()
+
+
+def test_map_resized_by_other_process():
+    with patch("daggerml_cli.db.MAP_SIZE_MIN", 1 << 22), tmp_repo(storage="lmdb") as repo:
+        size = repo.env.info()["map_size"]
+        code = "import sys; from daggerml_cli.repo import Repo\n"
+        code += "with Repo(sys.argv[1]) as r, r.tx(True): r('/big', 'x' * 2**24)"
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        subprocess.run([sys.executable, "-c", code, repo.path], check=True, env=env)  # eg. dml load next to dml serve
+        with repo.tx():
+            assert len(repo.get("/big")) == 1 << 24
+        assert repo.env.info()["map_size"] > size
+        with repo.tx(True):
+            repo.put_datum("still usable")
+
+
+def test_walk():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            index = repo.begin(message="test dag", name="test")
+            exe = Executable("foo:bar", data={"x": repo.put_datum([5, 6])}, prepop={"y": repo.put_datum(7)})
+            node = repo.put_node(Literal(repo.put_datum(exe)), index=index)
+            repo.commit(node, index)
+            datum = node().value
+            reachable = repo.walk(repo.head)
+            assert {datum, *exe_refs(datum)} <= reachable
+            ordered = repo.walk_ordered(node)
+            assert ordered[-1] == node
+            assert set(ordered) == {node, datum, *exe_refs(datum)}
+            assert len(ordered) == len(set(ordered))
+            for x in [node, repo.head]:
+                ordered = repo.walk_ordered(x)
+                for i, y in enumerate(ordered):
+                    assert set(iter_refs(repo.get(y))) <= set(ordered[:i])  # dependencies first
+            assert all(x.type in ["head", "commit"] for x in repo.walk(repo.head, prune=["tree"]))
+            assert {x.type for x in repo.walk(repo.head, prune=["datum"])} == {
+                "head",
+                "commit",
+                "tree",
+                "dag",
+                "shard",
+                "node",
+            }
+            repo.gc()
+            assert unroll_datum(datum) == Executable("foo:bar", data={"x": [5, 6]}, prepop={"y": 7})
+
+
+def exe_refs(datum):
+    value = datum().value
+    refs = [*value.data.values(), *value.prepop.values()]
+    return refs + [y for x in refs if isinstance(x().value, list) for y in x().value]
+
+
+def test_gc():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            for name in ["keep", "drop"]:
+                index = repo.begin(message=name, name=name)
+                nodes = [repo.put_node(Literal(repo.put_datum(x)), index=index) for x in [1, [name, 3], {"a": {4}}]]
+                repo.commit(nodes[-1], index)
+            repo.begin(message="open dag", name="open")
+            repo.put_datum(["orphan"])
+            repo.delete_dag("drop", "dropping")
+            garbage = repo.unreachable_objects()
+            reachable = repo.reachable_objects()
+            assert {x.type for x in garbage} >= {"datum"}  # intermediate dags are reclaimed on commit
+        with repo.tx(True):
+            deleted, _ = repo.gc(limit=1)
+            assert sum(deleted.values()) <= 1
+            deleted2, remaining = repo.gc()
+            assert sum((deleted + deleted2).values()) == len(garbage)
+            assert repo.unreachable_objects() == set()
+            assert repo.reachable_objects() == reachable
+            assert remaining == Counter(x.type for x in reachable if x.type != "deleted")
+            assert repo.gc()[0] == Counter()
+
+
+def test_reclaim_index_states():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            before = repo.objects()
+            index = repo.begin(message="d0", name="d0")
+            nodes = [repo.put_node(Literal(repo.put_datum(i)), index=index) for i in range(20)]
+            states = {x for x in repo.objects() - before if x.type in ["dag", "tree", "commit"]}
+            assert len(states) > 40
+            repo.commit(nodes[-1], index)
+            assert repo.unreachable_objects() == set()
+            assert states & repo.objects() == states & repo.reachable_objects()
+            assert len(states & repo.objects()) < 10
+            index = repo.begin(message="d1", name="d1")
+            repo.put_node(Literal(repo.put_datum("x")), index=index)
+            repo.delete(index)  # eg. by delete_index
+            assert repo.unreachable_objects() == set()
+            assert list(repo._tx[0].cursor(db=repo.meta["ephemeral"])) == []
+
+
+def test_gc_legacy_repo():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            repo.delete("/refcount")
+            index = repo.begin(message="test", name="test")
+            repo.commit(repo.put_node(Literal(repo.put_datum([1, 2])), index=index), index)
+            repo.put_datum(["orphan"])
+            garbage = repo.unreachable_objects()
+            assert len(garbage) > 0
+        with repo.tx(True):
+            deleted, _ = repo.gc()
+            assert sum(deleted.values()) == len(garbage)
+            assert repo.unreachable_objects() == set()
+            assert repo.refcount(repo.get_dag("test")) == 1
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_get_child_commits(legacy):
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            if legacy:
+                repo.delete("/children")
+            c0 = repo.get(repo.head).commit
+            for name in ["d0", "d1"]:
+                index = repo.begin(message=name, name=name)
+                repo.commit(repo.put_node(Literal(repo.put_datum(name)), index=index), index)
+            c2 = repo.get(repo.head).commit
+            (c1,) = repo.get(c2).parents
+            assert repo.get_child_commits(c0) == {c1}
+            assert repo.get_child_commits(c1) == {c2}
+            assert repo.get_child_commits(c2) == set()
+            c3 = repo.squash(c0, c1)
+            (c4,) = [x for x in repo.cursor("commit") if repo.get(x).parents == [c3]]
+            assert repo.get(c4).tree == repo.get(c2).tree
+            repo.set_head(repo.head, c4)
+            assert repo.get_child_commits(c3) == {c4}
+            repo.gc()
+            assert repo.get_child_commits(c0) == {c3}
+            assert repo.get_child_commits(c1) == set()
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_commit_graph(legacy):
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            if legacy:
+                repo.delete("/generation")
+            root = repo.get(repo.head).commit
+            tree = repo.get(root).tree
+
+            def commit(name, *parents):
+                return repo(Commit(list(parents), tree, "test", "test", name))
+
+            a1 = commit("a1", root)
+            a2 = commit("a2", a1)
+            b1 = commit("b1", root)
+            b2 = commit("b2", b1)
+            m = commit("m", a2, b1)
+            if legacy:
+                repo._tx[0].drop(repo.meta["generation"], delete=False)
+            assert [repo.generation(x) for x in [root, a1, a2, b1, b2, m]] == [1, 2, 3, 2, 3, 4]
+            assert repo.merge_base(a2, b2) == root
+            assert repo.merge_base(m, b2) == b1
+            assert repo.merge_base(b2, m) == b1
+            assert repo.merge_base(a1, m) == a1
+            assert repo.merge_base(m, m) == m
+            assert repo.is_ancestor(a1, m)
+            assert repo.is_ancestor(m, m)
+            assert not repo.is_ancestor(m, a1)
+            assert not repo.is_ancestor(b2, m)
+            assert repo.topo_sort(m) == [m, a2, a1, root, b1]
+            assert repo.merge(a2, m) == m
+            assert repo.merge(m, a2) == m
+            assert repo.get(repo.merge(m, b2)).parents == [m, b2]
+            repo.gc()
+            assert repo.get("/generation") is not None
+
+
+def test_generation_out_of_order():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            base = repo.get(repo.head).commit
+            tree = repo.get(base).tree
+
+            def commit(name, *parents):
+                return repo(Commit(list(parents), tree, "test", "test", name))
+
+            x2 = commit("x2", base)
+            p2 = commit("p2", commit("x", x2))
+            p1 = commit("p1", base)
+            m = commit("m", p1, p2)
+            dump = from_json(repo.dump_ref(m))
+            gens = {x: repo.generation(x) for x in [base, x2, p1, p2, m]}
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            repo.load_ref(to_json(dump[::-1]))  # children before their parents
+            assert {x: repo.generation(x) for x in gens} == gens
+            assert {
+                Ref(bytes(k).decode()): int(bytes(v)) for k, v in repo._tx[0].cursor(db=repo.meta["generation"])
+            } == {x: repo.generation(x) for x in repo.cursor("commit")}
+            assert repo.merge_base(p1, p2) == base
+
+
+def test_persistent_collections():
+    rng = random.Random(0)
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            pset, pmap = PSet(), PMap()
+            expected_set, expected_map = set(), {}
+            for i in range(1500):
+                k = f"k{rng.randrange(400)}"
+                if i % 3 == 2:
+                    pset.discard(k)
+                    expected_set.discard(k)
+                    assert pmap.pop(k, None) == expected_map.pop(k, None)
+                else:
+                    pset.add(k)
+                    expected_set.add(k)
+                    pmap[k] = expected_map[k] = i
+                assert len(pset) == len(expected_set)
+                assert len(pmap) == len(expected_map)
+            assert list(pset) == sorted(expected_set)
+            assert dict(pmap) == expected_map
+            assert all(k in pset for k in expected_set)
+            assert "nope" not in pset
+            # the trie's shape depends only on its contents
+            assert pset == PSet.of(expected_set)
+            assert pmap == PMap.of(expected_map)
+            assert pmap.root().children  # big enough to branch
+            other = PMap.of(expected_map)
+            other["k1"], other["new"] = "changed", "added"
+            del other[next(iter(expected_map))]
+            changes = {k: (a, b) for k, a, b in pmap.diff(other)}
+            assert changes == {k: (expected_map.get(k, NONE), dict(other).get(k, NONE)) for k in changes}
+            assert len(changes) == 3
+
+
+def test_put_node_writes_are_bounded():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            index = repo.begin(message="big dag", name="big")
+            nodes = [repo.put_node(Literal(repo.put_datum(i)), index=index, name=f"n{i}") for i in range(300)]
+            dag = repo.get(index).dag()
+            assert len(packb(dag)) < 200
+            assert list(dag.nodes) == sorted(set(nodes))
+            assert dag.names["n42"] == nodes[42]
+            assert dag.nameof(nodes[7]) == "n7"
+            depth, shard = 0, dag.nodes.root()
+            while shard.children:
+                depth += 1
+                shard = next(x for x in shard.children if x)()
+            assert 0 < depth < 4
+
+
+def test_object_cache():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            head = repo.head
+            commit = head().commit()
+            commit.message = "changed"
+            assert head().commit().message != "changed"  # callers get their own copy
+            obj = head()
+            obj.commit = repo.put(commit)
+            repo(head, obj)
+            assert head().commit().message == "changed"  # invalidated by put
+            ref = repo.put_datum([1, 2])
+            value = ref().value
+            ref().value.append(3)
+            assert ref().value == value
+            repo.delete(ref)
+            assert ref() is None  # invalidated by delete
+        with repo.tx():
+            assert head().commit().message == "changed"
+
+
+def test_put_known_keys():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            ref = repo.put_datum({"a": [1, 2], "b": [1, 2]})
+            assert ref.to in repo._known
+            assert repo.put_datum({"a": [1, 2], "b": [1, 2]}) == ref
+            repo.delete(ref)
+            assert ref.to not in repo._known
+            assert repo.put_datum({"a": [1, 2], "b": [1, 2]}) == ref
+            assert ref().value.keys() == {"a", "b"}  # written again after the delete
+        with repo.tx(True):
+            assert not repo._known
+            assert repo.put_datum({"a": [1, 2], "b": [1, 2]}) == ref
+
+
+def test_stage_datum():
+    value = {"a": [1, 2, {3}], "b": Resource("s3://x"), "c": [1, 2, {3}]}
+    with tmp_repo() as repo:
+        staged = repo.stage_datum(value)  # no transaction needed
+        with repo.tx(True):
+            ref = repo.put_staged(staged)
+            assert ref == staged.ref == repo.put_datum(value)
+            assert unroll_datum(ref()) == value
+            nested = repo.stage_datum([ref, 1])
+            assert nested.refs == [ref]
+            assert unroll_datum(repo.put_staged(nested)()) == [value, 1]
+            with pytest.raises(AssertionError, match="not a datum"):
+                repo.put_staged(repo.stage_datum([repo.head]))
+
+
+def test_staging():
+    with tmp_repo() as repo:
+        repo.staging = True
+        with repo.tx(True):
+            index = repo.begin(message="staged", name="staged")
+            empty = repo.get(index)
+            nodes = [repo.put_node(Literal(repo.put_datum(i)), index=index, name=f"n{i}") for i in range(3)]
+            assert repo.get(index) == empty  # nothing written to the dag yet
+            assert repo.staged(index) == [(x, f"n{i}") for i, x in enumerate(nodes)]
+        with repo.tx(True):
+            repo._rebuild_refcounts()
+            assert repo.gc()[0] == Counter()  # staged nodes are not garbage
+            assert all(x() for x in nodes)
+            repo.flush(index)
+            assert repo.staged(index) == []
+            dag = repo.get(index).dag()
+            assert list(dag.nodes) == sorted(nodes)
+            assert dict(dag.names) == {f"n{i}": x for i, x in enumerate(nodes)}
+            node = repo.put_node(Literal(repo.put_datum("last")), index=index)
+            ref = repo.commit(node, index)
+            assert list(ref().nodes) == sorted([*nodes, node])
+            assert repo.get(index) is None
+            assert list(repo._staging_entries()) == []
+
+
+def test_tree_diff():
+    with tmp_repo() as repo:
+        with repo.tx(True):
+            dag = repo(Dag([], {}, None, None))
+            dags = {f"dag{i}": dag for i in range(500)}
+            t1 = repo(Tree(dict(dags)))
+            assert isinstance(t1().dags, PMap)
+            assert t1().dags.root().children
+            dags2 = {**dags, "new": dag}
+            dags2.pop("dag3")
+            t2 = repo(Tree(dict(dags2)))
+            assert repo.diff(t1, t2) == {"add": {"new": dag}, "rem": {"dag3": dag}}
+            assert repo.diff(t1, t1) == {"add": {}, "rem": {}}
+            legacy = repo(Ref("tree/legacy"), Tree(dict(dags)))
+            assert isinstance(legacy().dags, dict)
+            assert repo.diff(legacy, t2) == repo.diff(t1, t2)
+            assert repo.patch(legacy, repo.diff(t1, t2)) == t2
+            assert repo.patch(t1, repo.diff(t1, t2)) == t2
+
+
+def test_map_growth():
+    with tmp_repo(storage="lmdb") as repo:
+        repo._resizer.growth = MapGrowth(factor=2, headroom=0)  # only grow when full
+        repo.env.set_mapsize(1024**2)
+        calls = []
+
+        def load():
+            calls.append(None)
+            with repo.tx(True):
+                return [repo.put_datum(f"{i:04d}" * 2500) for i in range(500)]
+
+        refs = repo.transact(load)
+        assert len(calls) > 1
+        assert repo.env.info()["map_size"] >= 4 * 1024**2
+        with repo.tx():
+            assert [len(x().value) for x in refs] == [10000] * 500
+        with pytest.raises(lmdb.MapFullError):
+            with repo.tx(True):  # nested calls leave replaying to the outermost one
+                repo.transact(lambda: [repo.put_datum(f"{i:04d}" * 25000) for i in range(500)])
+        repo._resizer.growth = MapGrowth(headroom=0.99)
+        size = repo.env.info()["map_size"]
+        with repo.tx(True):
+            pass
+        assert repo.env.info()["map_size"] == 2 * size
+
+
+def test_map_growth_parse():
+    assert MapGrowth.parse(None) == MapGrowth()
+    assert MapGrowth.parse("factor=1.5, max_size=1e9") == MapGrowth(factor=1.5, max_size=10**9)
+    with pytest.raises(ValueError, match="unknown map growth setting: nope"):
+        MapGrowth.parse("nope=1")
+    with pytest.raises(RuntimeError, match="at maximum"):
+        MapGrowth(max_size=100).next_size(100)
+
+
+def test_memory_storage():
+    tmpd = tempfile.mkdtemp()
+    try:
+        with Repo(tmpd, user="test", create=True, storage="memory") as repo:
+            with repo.tx(True):
+                index = repo.begin(message="test", name="test")
+                repo.commit(repo.put_node(Literal(repo.put_datum(42)), index=index), index)
+        assert not os.path.exists(f"{tmpd}/data.mdb")
+        with Repo(tmpd, storage="memory") as repo:
+            with repo.tx():
+                assert unroll_datum(repo.get_dag("test")().result().value) == 42
+        with pytest.raises(AssertionError, match="repo already exists"):
+            Repo(tmpd, create=True, storage="memory")
+        with pytest.raises(AssertionError, match="repo not found"):
+            Repo(tmpd, storage="lmdb")
+    finally:
+        shutil.rmtree(tmpd)
+    with pytest.raises(AssertionError, match="repo not found"):
+        Repo(tmpd, storage="memory")  # the data goes with the directory
+
+
+def test_split_repo():
+    with tmp_repo(split=True) as repo:
+        assert repo.blob_env is not None
+        with repo.tx(True):
+            index = repo.begin(message="test", name="test")
+            ref = repo.put_datum({"a": [1, 2]})
+            repo.commit(repo.put_node(Literal(ref), index=index), index)
+        with repo.blob_env.begin() as tx:
+            assert tx.get(ref.to.encode(), db=repo.dbs["datum"]) is not None
+        with repo.env.begin() as tx:
+            assert tx.get(ref.to.encode(), db=repo.dbs["node"]) is None
+            assert tx.stat(repo.dbs["node"])["entries"] == 1
+        with pytest.raises(ValueError, match="boom"):
+            with repo.tx(True, atomic=True):
+                orphan = repo.put_datum("rolled back")
+                raise ValueError("boom")
+        with repo.tx(True):
+            assert orphan() is None
+            repo.put_datum("orphan")
+            assert repo.gc()[0] == Counter(datum=1)
+        tmpd = tempfile.mkdtemp()
+        try:
+            repo.copy(tmpd)
+            with Repo(tmpd) as copied:
+                assert copied.split
+                with copied.tx():
+                    assert unroll_datum(copied.get_dag("test")().result().value) == {"a": [1, 2]}
+        finally:
+            shutil.rmtree(tmpd)
+
+
+def test_split_repo_blob_lock():
+    with tmp_repo(split=True) as repo:
+        with repo.blob_env.begin(write=True):  # blob writes elsewhere don't hold up other writes
+            done = threading.Event()
+
+            def write():
+                session = repo.session()
+                with session.tx(True):
+                    session.create_branch(Ref("head/other"), session.head)
+                done.set()
+
+            threading.Thread(target=write).start()
+            assert done.wait(10)
+        staged = repo.stage_datum({"x": ["big"]})
+        repo.write_staged(staged)
+        with repo.blob_env.begin() as tx:
+            assert tx.get(staged.ref.to.encode(), db=repo.dbs["datum"]) is not None
+        with repo.tx(True):
+            index = repo.begin(message="test", name="test")
+            repo.commit(repo.put_node(Literal(repo.put_staged(staged)), index=index), index)
+            assert not repo._bwrite  # the blobs were there already
+            assert repo.gc()[0] == Counter()
+            assert unroll_datum(repo.get_dag("test")().result().value) == {"x": ["big"]}
+            repo.put_staged(repo.stage_datum("unused"))
+            assert repo.gc()[0] == Counter(datum=1)
+
+
+def test_durability():
+    tmpd = tempfile.mkdtemp()
+    try:
+        with Repo(tmpd, user="test", create=True, durability="fast") as repo:
+            assert not repo.env.flags()["sync"]
+            with repo.tx(True):
+                index = repo.begin(message="test", name="test")
+                repo.commit(repo.put_node(Literal(repo.put_datum(42)), index=index), index)
+        with Repo(tmpd, durability="readonly") as repo:
+            assert repo.env.flags()["readonly"]
+            with repo.tx():
+                assert unroll_datum(repo.get_dag("test")().result().value) == 42
+            with pytest.raises(lmdb.ReadonlyError):
+                with repo.tx(True):
+                    pass
+    finally:
+        shutil.rmtree(tmpd)
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from daggerml_cli import api, db, server
+from daggerml_cli.repo import Error, Executable, from_json, to_json
+from tests.test_cli import cliTmpDirs
+from tests.util import SimpleApi
+
+SUM = Executable("./tests/fn/sum.py", adapter="dml-python-fork-adapter")
+
+
+@contextmanager
+def running_server(path, **kwargs):
+    srv = server.Server(path, **kwargs)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield srv
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        thread.join()
+
+
+class TestServer(TestCase):
+    def test_no_server(self):
+        with SimpleApi.begin() as d0:
+            assert server.invoke(d0.ctx, to_json(d0.token), to_json(["put_literal", [1], {}])) is None
+
+    def test_invoke(self):
+        with SimpleApi.begin() as d0:
+            with running_server(d0.ctx.SOCKET_PATH) as srv:
+                assert os.path.exists(d0.ctx.SOCKET_PATH)
+                resp = server.invoke(d0.ctx, to_json(d0.token), to_json(["put_literal", [{"a": 1}], {"name": "n0"}]))
+                n0 = from_json(resp)
+                resp = server.invoke(d0.ctx, to_json(d0.token), to_json(["start_fn", [], {"argv": [SUM, 1, 2]}]))
+                n1 = from_json(resp)
+                assert list(srv.repos) == [d0.ctx.REPO_PATH]
+                assert list(srv.caches) == [d0.ctx.CACHE_PATH]
+            assert not os.path.exists(d0.ctx.SOCKET_PATH)
+            assert d0.get_node("n0") == n0
+            assert d0.unroll(n0) == {"a": 1}
+            assert d0.unroll(n1)[1] == 3
+
+    def test_invoke_error(self):
+        with SimpleApi.begin() as d0:
+            with running_server(d0.ctx.SOCKET_PATH):
+                resp = server.invoke(d0.ctx, to_json(d0.token), to_json(["bogus", [], {}]))
+            err = from_json(resp)
+            assert isinstance(err, Error)
+            assert err.message == "no such op: bogus"
+
+    def test_concurrent(self):
+        with SimpleApi.begin() as d0:
+            with running_server(d0.ctx.SOCKET_PATH):
+                results = {}
+
+                def put(i):
+                    data = to_json(["put_literal", [i], {"name": f"n{i}"}])
+                    results[i] = from_json(server.invoke(d0.ctx, to_json(d0.token), data))
+
+                threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+                [x.start() for x in threads]
+                [x.join() for x in threads]
+            assert {i: d0.unroll(x) for i, x in results.items()} == {i: i for i in range(8)}
+            assert sorted(d0.get_names()) == sorted(f"n{i}" for i in range(8))
+
+    def test_group_commit(self):
+        with SimpleApi.begin() as d0:
+            with running_server(d0.ctx.SOCKET_PATH, group_window=0.5) as srv:
+                srv.repo(d0.ctx.REPO_PATH)
+                committer = srv.committers[d0.ctx.REPO_PATH]
+                groups, commit = [], committer._commit
+                committer._commit = lambda jobs: groups.append(len(jobs)) or commit(jobs)
+                results = {}
+
+                def put(i):
+                    if i == 3:
+                        data = [["put_literal", [i], {"name": f"n{i}"}], ["bogus", [], {}]]  # rolled back
+                    else:
+                        data = ["put_literal", [i], {"name": f"n{i}"}]
+                    results[i] = from_json(server.invoke(d0.ctx, to_json(d0.token), to_json(data)))
+
+                threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+                [x.start() for x in threads]
+                [x.join() for x in threads]
+            assert sum(groups) == 8
+            assert len(groups) < 8
+            assert isinstance(results.pop(3), Error)
+            assert {i: d0.unroll(x) for i, x in results.items()} == {i: i for i in results}
+            assert sorted(d0.get_names()) == sorted(f"n{i}" for i in results)
+
+    def test_reads_bypass_group_commit(self):
+        with SimpleApi.begin() as d0:
+            n0 = d0.put_literal(1, name="n0")
+            with running_server(d0.ctx.SOCKET_PATH, group_window=0.5) as srv:
+                srv.repo(d0.ctx.REPO_PATH)
+                committer = srv.committers[d0.ctx.REPO_PATH]
+                committer.submit = None  # reads must not go through it
+                for data in [["get_names", [], {}], [["get_node", ["n0"], {}], ["unroll", [api.OpResult(0)], {}]]]:
+                    start = time.monotonic()
+                    result = from_json(server.invoke(d0.ctx, to_json(d0.token), to_json(data)))
+                    assert time.monotonic() - start < 0.5
+                    assert result in [{"n0": n0}, [n0, 1]]
+
+    def test_client_settings(self):
+        with SimpleApi.begin() as d0:
+            d0.ctx._STAGING = True
+            d0.ctx._CACHE_COMPRESSION = "none"
+            with running_server(d0.ctx.SOCKET_PATH) as srv:
+                n0 = from_json(server.invoke(d0.ctx, to_json(d0.token), to_json(["put_literal", [1], {"name": "n0"}])))
+                req = {"repo_path": d0.ctx.REPO_PATH, "user": "test", "head": d0.ctx.BRANCHREF.to}
+                session = srv.session({**req, "cache_path": d0.ctx.CACHE_PATH, "settings": d0.ctx.SETTINGS})
+                assert session.staging
+                assert session._cache.compression == "none"
+                session = srv.session({**req, "cache_path": d0.ctx.CACHE_PATH, "settings": {}})
+                assert not session.staging
+                assert session._cache.compression == db.DEFAULT_COMPRESSION
+            with d0.tx() as repo:
+                assert n0 in [x for x, _ in repo.staged(d0.token)]
+
+    def test_already_running(self):
+        with TemporaryDirectory() as tmpd:
+            path = f"{tmpd}/dml.sock"
+            with running_server(path):
+                with self.assertRaisesRegex(RuntimeError, "server already running"):
+                    server.Server(path)
+
+    def test_cli_uses_server(self):
+        with cliTmpDirs() as dml:
+            dml.config_user("Testy McTesterstein")
+            dml.repo_create("repo0")
+            dml.config_repo("repo0")
+            d0 = dml.dag_create("d0", "dag d0")
+            with running_server(f"{dml._config_dir}/dml.sock") as srv:
+                n0 = d0("put_literal", data=42, name="n0")
+                assert list(srv.repos) == [f"{dml._config_dir}/repo/repo0"]
+                d0("commit", result=from_json(n0))
+            desc = dml.json("dag", "describe", "d0")
+            assert desc["nodes"][0]["name"] == "n0"
+            assert api.jsdata(from_json(n0)) == desc["result"]
@@ -31,6 +31,9 @@ class SimpleApi:
 
         return invoke
 
+    def batch(self, *ops):
+        return api.invoke_api(self.ctx, self.token, [list(x) for x in ops])
+
     @classmethod
     def begin(
         cls,